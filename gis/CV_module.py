@@ -0,0 +1,1105 @@
+"""
+Name:       CV_module.py
+
+Label:      Fit the imputer on datasets with held-out observations for cross-validation.
+
+Summary:    ThorNoe.GitHub.io/GreenGDP explains the overall approach and methodology.
+
+Usage:      This module runs the cross-validation (CV) of the imputation method applied
+            by script.py for any category of waterbodies, either from the command line,
+            e.g., from the gis folder (see python CV_module.py --help for all options):
+                python CV_module.py streams --subset sparse --n_jobs -1
+            or from the standalone scripts CV_coastal.py, CV_lakes.py, and CV_streams.py
+            that also describe the data. See GitHub.com/ThorNoe/GreenGDP for details.
+
+            With n_jobs other than 1, the fits are fanned out over a pool of workers.
+            The default backend uses worker processes that share the observed ecological
+            status in shared memory. On Windows, worker processes are spawned by
+            importing the main module, which requires the if __name__ == "__main__"
+            guard of the command line. Hence, the CV scripts use the threads backend
+            that avoids spawning processes but only gains from the parts of the fits
+            that release the GIL (linear algebra). Use the command line for processes.
+
+            With a checkpoint file, every finished prediction is appended to the file
+            right away. Rerunning skips the cells that are already in the file, so an
+            interrupted run resumes where it stopped.
+
+            With downdate=True, each fold is predicted by replaying the fit on the full
+            data for the rows with held-out cells only, which is much faster for large
+            datasets (streams). The deviation from refits is reported for a sample.
+
+            With --imputer soft or als, the CV benchmarks the low-rank imputer (see
+            imputation_module.py) against the chained equations by the same accuracy
+            score, e.g., python CV_module.py streams --cv kfold --imputer als
+
+Functions:  The class in this module contains 5 functions:
+            - predict() calls predict_many() for a single model.
+            - predict_many() fans out the fits with held-out cells of all the models
+              at once, which each call:
+                - predict_fold() or predict_fold_downdate()
+              and with downdate=True, it calls:
+                - check() to report the deviation from refits for a sample of folds.
+            - close() shuts down the workers and frees the shared memory.
+            Besides, make_folds() splits the held-out cells into folds for K-fold CV,
+            read_checkpoint(), open_checkpoint(), and append_checkpoint() read and
+            extend the checkpoint file, fingerprint() identifies the data, dummies, and
+            imputer of the stored predictions of a model, cv_suffix() gives the suffix
+            of the output files for the CV mode, and init_worker() attaches each worker
+            process to shared memory.
+
+            For the CV of a category j, main() parses the command line and calls:
+            - load_data() and typology() to set up the data and candidate dummies.
+            - stepwise_selection() to select dummies by CV using the class, which calls:
+                - race_candidates() to race the candidates on samples of cells.
+                - AccuracyScore()
+            - rescore() to score the stored predictions without refitting.
+            - set_style() and plot_results() to plot the scores and status by year.
+
+License:    MIT Copyright (c) 2025
+Author:     Thor Donsby Noe
+"""
+
+import argparse
+import copy
+import csv
+import hashlib
+import inspect
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import tqdm
+from cycler import cycler
+from scipy import stats
+from sklearn.metrics import accuracy_score
+from threadpoolctl import threadpool_limits
+
+import imputation_module
+
+# State of the current process: status matrix, dummies, and imputer (set once per pool)
+shared = {}
+lock = threading.Lock()  #  threads of the same process fit the full data only once
+
+
+def init_worker(shmName, shape, dummies, imputer):
+    """Attach a worker process to the observed ecological status in shared memory."""
+    shm = shared_memory.SharedMemory(name=shmName)
+    shared["shm"] = shm  #  keep a reference, otherwise the memory block is released
+    shared["status"] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    shared["dummies"] = dummies
+    shared["imputer"] = imputer
+
+    # Use one BLAS thread per worker process to avoid oversubscription of the cores
+    threadpool_limits(limits=1)
+
+
+def predict_fold(task):
+    """Omit the observed values of the cells in a fold (each cell is a waterbody i in a year t), fit the imputer, and return the predicted values of the omitted cells."""
+    cols, i, t = task  #  positions of the dummies used, the waterbodies, and the years
+    X = np.hstack([shared["status"], shared["dummies"][:, cols]])  #  same as merge
+    X[i, t] = np.nan  #  set the observed values as missing
+    imputer = copy.copy(shared["imputer"])  #  threads must not share the fitted state
+    return imputer.fit_transform(X)[i, t]  #  predicted values
+
+
+def predict_fold_downdate(task):
+    """Same as predict_fold(), but predict the omitted cells by downdating the fit of
+    the imputer on the full data (see held_out() in imputation_module.py). The full
+    data is fitted once per model (set of dummies) in each process. The fits of the
+    two latest models are kept, as folds of consecutive models overlap in time."""
+    cols, i, t = task
+    with lock:
+        fits = shared.setdefault("fitted", {})
+        if tuple(cols) not in fits:
+            X = np.hstack([shared["status"], shared["dummies"][:, cols]])
+            fitted = copy.deepcopy(shared["imputer"])
+            fitted.keep_path = True  #  keep the rounds of the fit for held_out()
+            fitted.fit_transform(X)
+            fits[tuple(cols)] = fitted
+            if len(fits) > 2:
+                del fits[next(iter(fits))]  #  drop the oldest fit
+        fitted = fits[tuple(cols)]
+    return fitted.held_out(i, t)
+
+
+def make_folds(cells, cv="loo", k=10, random_state=0):
+    """Split a list of cells (t, i) into folds of cells that are held out together.
+
+    - "loo": leave-one-out, i.e., each cell is a fold of its own (one fit per cell).
+    - "kfold": cells are assigned at random to k folds.
+    - "waterbody": waterbodies are assigned at random to k folds with all their cells.
+    - "year": years are assigned at random to k folds with all their cells."""
+    if cv == "loo":
+        return [[c] for c in cells]
+
+    # Group cells by waterbody, by year, or treat each cell as a group of its own
+    groups = {
+        "kfold": cells,
+        "waterbody": [i for t, i in cells],
+        "year": [t for t, i in cells],
+    }
+    if cv not in groups:
+        raise ValueError("cv must be 'loo', 'kfold', 'waterbody', or 'year'")
+    codes, uniques = pd.factorize(pd.Series(groups[cv]))
+
+    # Assign groups at random to k folds of (almost) equal size; same folds each call
+    rng = np.random.default_rng(random_state)
+    fold = np.empty(len(uniques), dtype=int)
+    fold[rng.permutation(len(uniques))] = np.arange(len(uniques)) % k
+    folds = [[] for _ in range(min(k, len(uniques)))]
+    for c, g in zip(cells, codes):
+        folds[fold[g]].append(c)
+    return folds
+
+
+def read_checkpoint(path):
+    """Read the predictions in the checkpoint file into a dictionary of dictionaries,
+    i.e., {(model, scheme): {(t, i): predicted value}}. A last line that was cut off
+    by a crash (no line break at the end) is removed from the file."""
+    done = {}
+    if path is None or not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        text = f.read()
+        f.truncate(text.rfind(b"\n") + 1)  #  drop any line that was cut off
+    lines = text.decode("utf-8").split("\n")[1:-1]  #  skip header and the last line
+    for model, scheme, t, i, pred in csv.reader(lines):
+        done.setdefault((model, scheme), {})[(int(t), int(i))] = float(pred)
+    return done
+
+
+def fingerprint(data, dfDummies, imputer):
+    """Digest of the observed status, the dummies of a model, and the type and
+    parameters of the imputer. It is part of the key of the stored predictions of the
+    model, so the checkpoint is not resumed after any of them changes (e.g., a new last
+    year), but it is resumed for the same model in another stepwise selection."""
+    names = inspect.signature(type(imputer).__init__).parameters
+    params = {p: getattr(imputer, p) for p in names if hasattr(imputer, p)}
+    h = hashlib.md5()
+    for df in (data, dfDummies):
+        h.update(repr((list(df.index), list(df.columns))).encode())
+        h.update(np.ascontiguousarray(df, dtype=np.float64).tobytes())
+    h.update(repr((type(imputer).__name__, sorted(params.items()))).encode())
+    return h.hexdigest()[:8]
+
+
+def open_checkpoint(path):
+    """Open the checkpoint file for appending (with a header if the file is new)."""
+    newFile = not os.path.exists(path)
+    f = open(path, "a", newline="", encoding="utf-8")
+    if newFile:
+        f.write("model,scheme,year,wb,pred\n")  #  header
+    return f
+
+
+def append_checkpoint(f, model, scheme, cells, pred):
+    """Append the predicted values of cells (t, i) to the open checkpoint file. The
+    lines are flushed right away, so they are kept if the process crashes, while the
+    caller syncs the file to disk (os.fsync) once per model, as syncing is slow."""
+    writer = csv.writer(f, lineterminator="\n")
+    for (t, i), p in zip(cells, pred):
+        writer.writerow([model, scheme, t, i, repr(float(p))])  #  exact float
+    f.flush()
+
+
+class CV_Engine:
+    """Engine for fitting the imputer once for each fold of held-out cells"""
+
+    def __init__(
+        self,
+        data,
+        dfDummies,
+        imputer,
+        n_jobs=1,
+        checkpoint=None,
+        downdate=False,
+        n_check=20,
+        backend="processes",
+    ):
+        """Share the observed status (data) and the candidate dummies (dfDummies) with
+        a pool of worker processes. Use all cores if n_jobs=-1 and no pool if n_jobs=1.
+        If a path to a checkpoint file (CSV) is given, resume from its predictions of
+        each model for the same data, dummies, and imputer settings (see fingerprint).
+
+        The backend is "processes" (shared memory), "threads" (one process, where
+        numpy releases the GIL in linear algebra), or "serial" (same as n_jobs=1).
+
+        With downdate=True, the folds are predicted by downdating the fit on the full
+        data instead of refitting (requires imputation_module.Chained_Imputer). Then
+        n_check random folds are also refitted to report the deviation from refits.
+        """
+        if downdate and not hasattr(imputer, "held_out"):
+            raise ValueError("downdate requires imputation_module.Chained_Imputer")
+        if backend not in ("serial", "threads", "processes"):
+            raise ValueError("backend must be 'serial', 'threads', or 'processes'")
+        self.downdate, self.n_check = downdate, n_check
+        self.deviations = {}  #  downdated and refitted predictions of checked cells
+        self.checkpoint = checkpoint
+        self.done = read_checkpoint(checkpoint)  #  predictions from earlier runs
+        self.data, self.imputer = data, imputer  #  for the fingerprint of each model
+        self.dfDummies = dfDummies.reindex(data.index)
+        self.index = data.index
+        self.columns = data.columns
+        self.dummies = list(dfDummies.columns)
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        status = np.array(data, dtype=np.float64)
+        dummies = np.array(dfDummies.reindex(data.index), dtype=np.float64)
+        self.n_obs = np.isfinite(status).sum(axis=0)  #  observed values by column
+
+        self.shm, self.executor, self.limits = None, None, None
+        if self.n_jobs == 1 or backend != "processes":
+            # Serial execution and threads use the same state in the main process
+            shared.update(status=status, dummies=dummies, imputer=imputer)
+
+            if self.n_jobs != 1 and backend == "threads":
+                # Use one BLAS thread per thread to avoid oversubscription of the cores
+                self.limits = threadpool_limits(limits=1)
+                self.executor = ThreadPoolExecutor(max_workers=self.n_jobs)
+
+        else:
+            # Copy the observed ecological status to a block of shared memory once
+            self.shm = shared_memory.SharedMemory(create=True, size=status.nbytes)
+            buffer = np.ndarray(status.shape, dtype=np.float64, buffer=self.shm.buf)
+            buffer[:] = status
+
+            # Start worker processes that attach to the shared memory at startup
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.n_jobs,
+                initializer=init_worker,
+                initargs=(self.shm.name, status.shape, dummies, imputer),
+            )
+
+    def predict(self, predictors, cells, cv="loo", k=10):
+        """For the model with the given predictors (dummies), predict each cell (t, i) in the list of cells after omitting its observed value along with the other cells in its fold (see make_folds). Returns a Series of predicted values with (year, waterbody) as index."""
+        return self.predict_many([predictors], cells, cv, k)[0]
+
+    def predict_many(self, models, cells, cv="loo", k=10):
+        """Same as predict() for a list of models (each a list of predictors), where
+        the folds of all models are scheduled at once. Thus, the workers continue with
+        the next model while the last folds of a model are still being fitted, i.e.,
+        the candidate models of a round in stepwise selection are fitted concurrently.
+        Returns a list with a Series of predicted values for each model."""
+        folds = make_folds(cells, cv, k)
+        rows = [self.index.get_indexer([i for t, i in fold]) for fold in folds]
+        years = [self.columns.get_indexer([t for t, i in fold]) for fold in folds]
+
+        # A fold must not hold out every observed value of a year (empty column)
+        for t in years:
+            heldOut = np.bincount(t, minlength=len(self.columns))
+            if np.any((heldOut > 0) & (heldOut >= self.n_obs)):
+                raise ValueError(
+                    "A fold holds out every observed value of a year. Use a subset, "
+                    "more folds, or another CV mode than '{0}'".format(cv)
+                )
+
+        # CV scheme (folds depend on the cells unless LOO) as key besides model name
+        scheme = cv
+        if cv != "loo":
+            digest = hashlib.md5(repr(cells).encode()).hexdigest()[:8]
+            scheme = "{0}{1}_{2}".format(cv, k, digest)
+        if self.downdate:
+            scheme += "_downdate"  #  approximate predictions are stored separately
+
+        names, schemes, tasks, dones, jobs = [], [], [], [], []  #  jobs are (m, fold n)
+        for m, predictors in enumerate(models):
+            cols = [self.dummies.index(p) for p in predictors]  #  positions of dummies
+            names.append(", ".join(predictors) if predictors else "No dummies")
+            key = fingerprint(self.data, self.dfDummies[predictors], self.imputer)
+            schemes.append(scheme + "_" + key)  #  same data, dummies, and imputer
+            tasks.append([(cols, i, t) for i, t in zip(rows, years)])
+            dones.append(self.done.setdefault((names[m], schemes[m]), {}))
+
+            # Skip the folds where every cell is stored in the checkpoint file already
+            todo = [n for n, f in enumerate(folds) if not all(c in dones[m] for c in f)]
+            if len(todo) < len(folds):
+                print(len(folds) - len(todo), "folds of", names[m], "are resumed")
+            jobs += [(m, n) for n in todo]
+
+        file = None if self.checkpoint is None else open_checkpoint(self.checkpoint)
+        remaining = np.bincount([m for m, n in jobs], minlength=len(models))
+
+        def store(m, n, pred):
+            """Store the predictions of model m for fold n and append to checkpoint."""
+            dones[m].update(zip(folds[n], pred))
+            remaining[m] -= 1
+            if file is not None:
+                append_checkpoint(file, names[m], schemes[m], folds[n], pred)
+                if remaining[m] == 0:
+                    os.fsync(file.fileno())  #  sync to disk once the model is done
+
+        func = predict_fold_downdate if self.downdate else predict_fold
+        try:
+            if self.executor is None:
+                # Fit the imputer for one fold of held-out cells at a time
+                for m, n in tqdm.tqdm(jobs):
+                    store(m, n, func(tasks[m][n]))
+
+            else:
+                # Fan the fits out over all workers; store each fold when it is finished
+                futures = {
+                    self.executor.submit(func, tasks[m][n]): (m, n) for m, n in jobs
+                }
+                for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                    store(*futures[future], future.result())
+        finally:
+            if file is not None:
+                file.close()
+
+        if self.downdate and self.n_check > 0:
+            for m in range(len(models)):
+                self.check(names[m], schemes[m], folds, tasks[m], dones[m])
+
+        cells = [c for fold in folds for c in fold]  #  cells in the order of folds
+        index = pd.MultiIndex.from_tuples(cells, names=["year", "wb"])
+        return [
+            pd.Series([d[c] for c in cells], index=index, dtype=float) for d in dones
+        ]
+
+    def check(self, model, scheme, folds, tasks, done):
+        """Refit the imputer for n_check random folds and report how far the downdated
+        predictions deviate from the refits, including how many cells would get another
+        ecological status (categorical scale with equidistant thresholds)."""
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(folds), min(self.n_check, len(folds)), replace=False)
+        if self.executor is None:
+            refits = [predict_fold(tasks[n]) for n in sample]
+        else:
+            refits = list(self.executor.map(predict_fold, [tasks[n] for n in sample]))
+        cells = [c for n in sample for c in folds[n]]
+        dev = pd.DataFrame(
+            {"downdate": [done[c] for c in cells], "refit": np.concatenate(refits)},
+            index=pd.MultiIndex.from_tuples(cells, names=["year", "wb"]),
+        )
+        self.deviations[(model, scheme)] = dev
+
+        # Report the deviation from refits
+        diff = (dev["downdate"] - dev["refit"]).abs()
+        thresholds = [0.5, 1.5, 2.5, 3.5]  #  Bad, Poor, Moderate, Good, High
+        other = np.digitize(dev["downdate"], thresholds) != np.digitize(
+            dev["refit"], thresholds
+        )
+        print(
+            "Deviation from refits for {0} ({1} cells): mean {2:.4f}, max {3:.4f}, "
+            "other status for {4} cells".format(
+                model, len(cells), diff.mean(), diff.max(), other.sum()
+            )
+        )
+
+    def close(self):
+        """Shut down the worker processes (or threads) and free the shared memory."""
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+        if self.limits is not None:
+            self.limits.restore_original_limits()
+        shared.clear()
+
+
+# Settings by category: max rounds of the imputer, the sparse subset (waterbodies
+# observed at most this many times), and the candidate dummies for stepwise selection
+categories = {
+    "coastal": {
+        "max_iter": 100,
+        "sparse": None,  #  all observed values are used for CV
+        "dummies": [
+            "No",
+            "K",
+            "B",
+            "Ø",
+            "Fj",
+            "Vf",
+            "Vu",
+            "F",
+            "D",
+            "L",
+            "Se",
+            "Sa",
+            "T",
+        ],
+        "label": "coastal waters",
+    },
+    "lakes": {
+        "max_iter": 1000,
+        "sparse": 4,
+        "dummies": ["Alkalinity", "Brown", "Saline", "Deep", "DK2"],
+        "label": "lakes",
+    },
+    "streams": {
+        "max_iter": 100,
+        "sparse": 3,
+        "dummies": ["Small", "Medium", "Large", "Soft bottom", "Natural", "DK2"],
+        "label": "streams",
+    },
+}
+
+# Abbreviations in the typology of coastal waters
+dict1 = {
+    "No": "North Sea",  # Nordsø
+    "K": "Kattegat",  # Kattegat
+    "B": "Belt Sea",  # Bælthav
+    "Ø": "Baltic Sea",  # Østersøen
+    "Fj": "Fjord",  # Fjord
+    "Vf": "North Sea fjord",  # Vesterhavsfjord
+}
+dict2 = {
+    "Vu": "Water exchange",  # vandudveksling
+    "F": "Freshwater inflow",  # ferskvandspåvirkning
+    "D": "Deep",  # vanddybde
+    "L": "Stratified",  # lagdeling
+    "Se": "Sediment",  # sediment
+    "Sa": "Saline",  # salinitet
+    "T": "Tide",  # tidevand
+}
+
+
+def process_string(s):
+    """Dummies for the abbreviations in the typology of a coastal water."""
+    # Drop the hyphen and everything following it
+    s = s.split("-")[0]
+
+    # Create a dictionary with the relevant abbreviations as keys and 1s as values
+    dummies = {}
+
+    # Check for abbreviations from dict1 first
+    for abbr in dict1:
+        if abbr in s:
+            dummies[abbr] = 1
+            s = s.replace(abbr, "")  # Remove the matched abbreviation from the string
+
+    # Then check for abbreviations from dict2
+    for abbr in dict2:
+        if abbr in s:
+            dummies[abbr] = 1
+
+    return dummies
+
+
+def typology(j, dfVP):
+    """Dummies for the typology (and district) of each waterbody in category j."""
+    if j == "streams":
+        # Create dummies for typology
+        typ = pd.get_dummies(dfVP["ov_typ"]).astype(int)
+        typ["Soft bottom"] = typ["RW4"] + typ["RW5"]
+        typ.columns = [
+            "Small",
+            "Medium",
+            "Large",
+            "Small w. soft bottom",
+            "Medium w. soft bottom",
+            "Soft bottom",  #  only 1 of 261 streams in basis analysis but not observed
+        ]
+
+        # Create dummies for natural, artificial, and heavily modified waterbodies
+        natural = pd.get_dummies(dfVP["na_kun_stm"]).astype(int)
+        natural.columns = ["Artificial", "Natural", "Heavily modified"]
+        typ = typ.merge(natural[["Natural"]], on="wb")
+
+    elif j == "lakes":
+        # Convert typology to integers
+        typ = dfVP[["ov_typ"]].copy()
+        typ.loc[:, "type"] = typ["ov_typ"].str.slice(6).astype(int)
+
+        # Create dummies for high Alkalinity, Brown, Saline, and Deep lakes
+        cond1 = [(typ["type"] >= 9) & (typ["type"] <= 16), typ["type"] == 17]
+        typ["Alkalinity"] = np.select(cond1, [1, np.nan], default=0)
+        cond2 = [typ["type"].isin([5, 6, 7, 8, 13, 14, 15, 16]), typ["type"] == 17]
+        typ["Brown"] = np.select(cond2, [1, np.nan], default=0)
+        cond3 = [typ["type"].isin([2, 3, 7, 8, 11, 12, 15, 16]), typ["type"] == 17]
+        typ["Saline"] = np.select(cond3, [1, np.nan], default=0)
+        cond4 = [typ["type"].isin(np.arange(2, 17, 2)), typ["type"] == 17]
+        typ["Deep"] = np.select(cond4, [1, np.nan], default=0)
+        typ = typ.drop(columns=["ov_typ", "type"])
+
+    else:  #  coastal waters
+        # Dummies for the abbreviations in the typology (see dict1 and dict2)
+        typ = dfVP["ov_typ"].apply(process_string).apply(pd.Series)
+        typ = typ.fillna(0).astype(int)[list({**dict1, **dict2})]
+        return typ
+
+    # Create dummy for waterbody district DK2 (Sealand, Lolland, Falster, and Møn)
+    distr = pd.get_dummies(dfVP["distr_id"]).astype(int)
+    return typ.merge(distr[["DK2"]], on="wb")
+
+
+def load_data(j):
+    """Read the observed ecological status and the characteristics of the waterbodies in
+    category j from the output folder (set up by script.py)."""
+    dfEcoObs = pd.read_csv("output/" + j + "_eco_obs.csv", index_col="wb")
+    dfEcoObs.columns = dfEcoObs.columns.astype(int)
+    dfVP = pd.read_csv("output/" + j + "_VP.csv", index_col="wb")
+    return dfEcoObs, dfVP
+
+
+# Function for accuracy score of predicted ecological status
+def AccuracyScore(y_true, y_pred):
+    """Convert continuous prediction of ecological status to categorical index and return accuracy score, i.e., the share of observed waterbodies each year where predicted ecological status matches the true ecological status (which LOO-CV omits from the dataset before applying imputation)."""
+    eco_true, eco_pred = [], []  #  empy lists for storing transformed observations
+    for a, b in zip([y_true, y_pred], [eco_true, eco_pred]):
+        # Demarcation for categorical ecological status: Bad, Poor, Moderate, Good, High
+        conditions = [
+            a < 0.5,  # Bad
+            (a >= 0.5) & (a < 1.5),  #  Poor
+            (a >= 1.5) & (a < 2.5),  #  Moderate
+            a >= 2.5,  #  Good or High
+        ]
+        b.append(np.select(conditions, [0, 1, 2, 3], default=np.nan))  #  add to list
+    return accuracy_score(eco_true[0], eco_pred[0])
+
+
+def race_candidates(
+    engine, data, models, cells, start, confidence=0.95, cv="loo", k=10, seed=0
+):
+    """Successive halving of the candidate models of a round in stepwise selection.
+
+    All models are scored on a random sample with the share start of the cells. A
+    model is dropped if its accuracy is lower than that of the best model with the
+    given (one-sided) confidence: a paired test of the difference in whether each
+    cell is predicted correctly by the best model and by the model (normal
+    approximation). The sample is doubled for the remaining models until it covers
+    half of the cells or only one model remains. The samples are nested, so with
+    LOO-CV, the predictions are reused by the full evaluation of the survivors.
+
+    Returns the positions of the surviving models and a DataFrame with the sample
+    size, accuracy, and difference from the best model in each stage."""
+    order = np.random.default_rng(seed).permutation(len(cells))
+    z = stats.norm.ppf(confidence)  #  critical value of the one-sided test
+    thresholds = [0.5, 1.5, 2.5]  #  Bad, Poor, Moderate, Good or High
+    alive = list(range(len(models)))
+    stages = []  #  empty list for storing the results of each stage
+    n = max(int(start * len(cells)), 1)  #  size of the first sample
+    while len(alive) > 1 and n <= len(cells) / 2:
+        sample = [cells[c] for c in np.sort(order[:n])]
+        index = pd.MultiIndex.from_tuples(sample, names=["year", "wb"])
+        true = np.digitize([data.at[i, t] for t, i in sample], thresholds)
+
+        # Whether each cell is predicted correctly by each remaining model
+        preds = engine.predict_many([models[m] for m in alive], sample, cv, k)
+        correct = np.array([np.digitize(p[index], thresholds) == true for p in preds])
+        correct = correct.astype(float)
+
+        # Paired difference in accuracy from the best model and its standard error
+        best = np.argmax(correct.mean(axis=1))
+        diff = correct[best] - correct
+        se = diff.std(axis=1, ddof=1) / np.sqrt(n) if n > 1 else np.inf
+        dropped = diff.mean(axis=1) - z * se > 0  #  clearly worse than the best model
+        for a, m in enumerate(alive):
+            stages.append(
+                {
+                    "model": ", ".join(models[m]) if models[m] else "No dummies",
+                    "cells": n,
+                    "total": len(cells),
+                    "accuracy": correct[a].mean(),
+                    "diff": diff[a].mean(),
+                    "se": se[a] if n > 1 else np.nan,
+                    "confidence": confidence,
+                    "dropped": dropped[a],
+                }
+            )
+        print(
+            "Racing on {0} of {1} cells: dropped {2} of {3} candidates".format(
+                n, len(cells), dropped.sum(), len(alive)
+            )
+        )
+        alive = [m for a, m in enumerate(alive) if not dropped[a]]
+        n *= 2  #  double the sample for the remaining models
+    return alive, pd.DataFrame(stages)
+
+
+def stepwise_selection(
+    j,
+    subset,
+    dummies,
+    data,
+    dfDummies,
+    years,
+    imputer,
+    label="",
+    select_all=False,
+    n_jobs=1,
+    backend="processes",
+    cv="loo",
+    k=10,
+    checkpoint=None,
+    downdate=False,
+    racing=None,
+    confidence=0.95,
+):
+    """Forward stepwise selection of predictors p to include in the model for category j.
+
+    CSV names are output/j_eco_imp_accuracy and output/j_eco_imp_LessThanGood with the
+    given label (e.g., "_sparse") for the scores and status of the selected models and
+    with the label and "_all" for every model tested. The CSVs are saved every round.
+
+    With select_all=True, the dummies are included in the order they are listed.
+
+    With n_jobs=-1, the LOO-CV fits are fanned out over all cores (identical results)
+    using worker processes or threads as set by the backend (see CV_Engine). The
+    candidate dummies of each round are evaluated concurrently, and the best one is
+    picked once all of them are finished (see CV_Engine.predict_many).
+
+    Instead of LOO-CV (one fit per observed cell), cv="kfold" masks k random folds of
+    cells per fit, while cv="waterbody" or cv="year" masks k folds of waterbodies or
+    years with all their cells (see make_folds). CSV names get the suffix cv. As a
+    year fold must leave some observed values of the year, cv="year" requires a subset
+    of the observed waterbodies (e.g., the sparsely observed ones).
+
+    Every prediction is appended to the checkpoint file (CSV) when it is finished, and
+    a rerun skips the predictions that are already there, e.g., after a crash.
+
+    With downdate=True, each fit is replaced by replaying the fit on the full data for
+    the held-out cells only (much faster for many waterbodies), and the deviation from
+    refits is reported for a sample of the folds. CSV names get the suffix downdate.
+
+    With racing set to a share of the cells (e.g., 0.05), the candidates of each round
+    are first raced on nested random samples of the cells (see race_candidates), and
+    only the candidates that are not clearly worse than the best one with the given
+    confidence are evaluated on all cells. The sample sizes, accuracy, and the paired
+    difference from the best candidate in each stage are saved to the CSV named
+    output/j_eco_imp_racing with the given label (and suffix).
+
+    Every held-out prediction is stored along with the observed value by model, year,
+    and waterbody in the Parquet file output/j_eco_imp_predictions with the given label
+    and suffix, so other metrics can be computed without refitting (see rescore).
+    """
+    predictors = ["No dummies"] + dummies  #  list of possible predictors to include
+    selected = []  #  empty list for storing selected predictors
+    current_score, best_new_score = 0.0, 0.0  #  initial scores
+    suffix = cv_suffix(cv, downdate)  #  suffix for CSV names if not LOO-CV
+    prefixes = ["output/" + j + "_eco_imp_" + a for a in ("accuracy", "LessThanGood")]
+
+    # DataFrame for storing accuracy scores by year and calculating weighted average
+    scores = pd.DataFrame(subset.count(), index=years, columns=["n"]).astype(int)
+    scores.loc["Total", "n"] = np.nan  #  row to calculate weighted average of scores
+    scores_all = scores.copy()  #  scores for all sets of predictors being tested
+
+    # DataFrame for storing ecological status by year and calculating weighted average
+    status = scores.copy()  #  likewise, covers the years in the natural capital account
+    status["Obs"] = (subset[years] < 2.5).sum() / status["n"]  #  eco status < good
+    status.loc["Total", "Obs"] = (status["Obs"] * status["n"]).sum() / status["n"].sum()
+    status_all = status.copy()  #  eco status for all sets of predictors being tested
+
+    racingStages = []  #  empty list for storing the stages of racing in each round
+    predictions = []  #  empty list for storing the held-out predictions of each model
+    store = "output/" + j + "_eco_imp_predictions" + label + suffix + ".parquet"
+
+    def save():
+        """Overwrite the CSVs of scores and status for selected and all models."""
+        for a, b, c in zip([scores, status], [scores_all, status_all], prefixes):
+            a.to_csv(c + label + suffix + ".csv")
+            b.to_csv(c + label + "_all" + suffix + ".csv")
+        if predictions:
+            pd.concat(predictions).to_parquet(store, index=False)  #  see rescore()
+        if racingStages:
+            racing_csv = "output/" + j + "_eco_imp_racing" + label + suffix + ".csv"
+            pd.concat(racingStages).to_csv(racing_csv, index=False)
+
+    # Observed cells (year t, waterbody i) in the subset to loop over with CV
+    cells = [(t, i) for t in years for i in subset[subset[t].notnull()].index]
+
+    # Engine for CV fits, sharing the observed status with n_jobs workers
+    engine = CV_Engine(
+        data, dfDummies[dummies], imputer, n_jobs, checkpoint, downdate, 20, backend
+    )
+
+    while current_score == best_new_score:
+        names = []  #  empty list for storing model names
+        scores_total = []  #  empty list for storing total score for each predictor
+        sco = scores[["n"]].copy()  #  df for calculating weighted average of scores
+        sta = status[["n"]].copy()  #  df for calculating weighted average of status
+
+        # Candidates of the round: baseline model, the next dummy listed, or all
+        if predictors[0] == "No dummies" or select_all is True:
+            candidates = predictors[:1]
+        else:
+            candidates = predictors
+        models = [[] if p == "No dummies" else selected + [p] for p in candidates]
+
+        # Race the candidates on samples of cells and keep those not clearly worse
+        if racing and len(candidates) > 1:
+            alive, stages = race_candidates(
+                engine, data, models, cells, racing, confidence, cv, k
+            )
+            stages.insert(0, "round", len(selected) + 1)  #  round of the selection
+            racingStages.append(stages)
+            candidates = [candidates[m] for m in alive]
+            models = [models[m] for m in alive]
+
+        # Predict each observed value after omitting its fold for all candidates of the
+        # round at once, so the workers fit the candidate models concurrently
+        preds = engine.predict_many(models, cells, cv, k)
+
+        for p, predictors_used, pred in zip(candidates, models, preds):
+            if p == "No dummies":  #  baseline model without any dummies
+                df = data.copy()  #  df without predictors
+                df.name = "No dummies"  #  name baseline model
+            else:
+                df = data.merge(dfDummies[predictors_used], on="wb")  #  with predictors
+                df.name = ", ".join(predictors_used)  #  name model after its predictors
+            names.append(df.name)  #  add model name to list of model names
+
+            # Estimate share with less than good ecological status
+            dfImp = pd.DataFrame(
+                imputer.fit_transform(np.array(df)), index=df.index, columns=df.columns
+            )
+
+            # Subset to the waterbodies included in the subset and drop predictors
+            dfImpSubset = dfImp.loc[subset.index, subset.columns]
+
+            # Predicted share with less than good ecological status for relevant years
+            sta[df.name] = (dfImpSubset[years] < 2.5).sum() / len(subset)
+
+            # Accuracy each year t over the waterbodies i observed in the subset
+            for t in years:
+                y = subset[subset[t].notnull()].index  #  index for LOO-CV at year t
+                Y = pd.DataFrame(index=y)  #  empty df for observed and predicted values
+                Y["true"] = df.loc[y, t]  #  column with the observed ('true') values
+                Y["pred"] = pred.loc[t]  #  column with the predicted values
+
+                # Accuracy of predicted ecological status
+                accuracy = AccuracyScore(Y["true"], Y["pred"])
+
+                # Save accuracy score each year to DataFrame for scores
+                sco.loc[t, df.name] = accuracy
+
+            # Total accuracy weighted by number of observations used for LOO-CV each year
+            for a, b in zip([scores_all, status_all], [sco, sta]):
+                b.loc["Total", df.name] = (b[df.name] * b["n"]).sum() / b["n"].sum()
+                a[df.name] = b[df.name]  #  scores & status by year for all predictors
+            scores_total.append(sco.loc["Total", df.name])  #  score for each predictor
+
+            print(df.name, "used for imputation. Accuracy score:", scores_total[-1])
+
+            # Store the held-out predictions along with the observed values
+            wb, year = pred.index.get_level_values("wb"), pred.index.get_level_values(0)
+            true = np.array(df)[df.index.get_indexer(wb), df.columns.get_indexer(year)]
+            predictions.append(
+                pd.DataFrame(
+                    {
+                        "model": df.name,
+                        "year": year,
+                        "wb": wb,
+                        "true": true,
+                        "pred": pred,
+                    }
+                )
+            )
+
+        best_new_score = max(scores_total)  #  best accuracy score among predictors
+
+        if select_all is True:
+            current_score = best_new_score  #  update current score to continue process
+
+            # Move the given dummy from the list of predictors to the list of selected
+            selected.append(predictors.pop(0))
+
+            # Save scores and status by year for the given set of predictors
+            for a, b in zip([scores, status], [sco, sta]):
+                a[names[-1]] = b[names[-1]]  #  scores & status by year for predictor
+            save()  #  overwrite CSVs
+
+        elif best_new_score > current_score:
+            current_score = best_new_score  #  update current score
+            i = scores_total.index(best_new_score)  #  index for candidate w. best score
+
+            # Move dummy with the best new score from the list of predictors to selected
+            # (by name, as racing may have dropped candidates listed before it)
+            best = candidates[i]
+            selected.append(best)
+            predictors.remove(best)
+
+            # Save scores and status by year subject to the selected set of predictors
+            for a, b in zip([scores, status], [sco, sta]):
+                a[names[i]] = b[names[i]]  #  scores & status by year for best predictor
+            save()  #  overwrite CSVs
+
+        else:  #  if best_new_score == current_score (i.e., identical accuracy score)
+            break  #  stop selection (including the predictor would increase variance)
+
+        if p == "No dummies":
+            selected = []  #  after baseline model, start actual stepwise selection
+
+        elif predictors == []:  #  if all predictors have been included
+            break  #  stop stepwise selection
+
+    # Shut down the worker processes
+    engine.close()
+
+    # Total number of observations that LOO-CV was performed over
+    for s in (scores, status, scores_all, status_all):
+        s.loc["Total", "n"] = s["n"].sum()
+
+    # Overwrite CSVs of accuracy scores and share with less than good ecological status
+    save()
+
+    return selected, scores, status  #  selected predictors; scores and stats by year
+
+
+def rescore(path, thresholds=(0.5, 1.5, 2.5), good=2.5, models=None):
+    """Score the held-out predictions in the store written by stepwise_selection()
+    without refitting. The categories of ecological status are given by thresholds
+    (default: Bad, Poor, Moderate, and Good or High as in AccuracyScore). Optionally,
+    only read the given list of models.
+
+    Returns three DataFrames: the accuracy by year and model (total weighted by the
+    number of cells each year), confusion matrices of the observed (rows) and the
+    predicted (columns) categories by model, and the share of held-out cells with
+    less than good ecological status by year as observed and as predicted by model.
+    """
+    filters = [("model", "in", models)] if models else None
+    df = pd.read_parquet(path, filters=filters)
+    names = list(df["model"].unique())  #  models in the order they were evaluated
+    true = np.digitize(df["true"], thresholds)  #  observed category of each cell
+    pred = np.digitize(df["pred"], thresholds)  #  predicted category of each cell
+    df["correct"] = true == pred
+    df["below"] = df["pred"] < good
+    n = df[df["model"] == names[0]].groupby("year").size()  #  cells each year
+
+    # Accuracy by year and model; total weighted by number of cells each year
+    accuracy = df.pivot_table("correct", "year", "model", "mean")[names]
+    accuracy.loc["Total"] = df.groupby("model")["correct"].mean()[names]
+    accuracy.insert(0, "n", n)
+    accuracy.loc["Total", "n"] = n.sum()
+
+    # Confusion matrices of observed and predicted categories by model
+    confusion = pd.crosstab(
+        [df["model"], true], pred, rownames=["model", "true"], colnames=["pred"]
+    ).reindex(names, level=0)
+
+    # Share with less than good ecological status by year: observed and predicted
+    status = df.pivot_table("below", "year", "model", "mean")[names]
+    status.loc["Total"] = df.groupby("model")["below"].mean()[names]
+    obs = df[df["model"] == names[0]]
+    status.insert(0, "Obs", (obs["true"] < good).groupby(obs["year"]).mean())
+    status.loc["Total", "Obs"] = (obs["true"] < good).mean()
+    status.insert(0, "n", accuracy["n"])
+    return accuracy, confusion, status
+
+
+def set_style(j):
+    """Set the default property-cycle and figure size for pyplots of category j using
+    a color-blind-friendly color scheme for qualitative data by Tol: personal.sron.nl/~pault
+    """
+    if j == "coastal":  #  10 colors for up to 8 selected dummies
+        colors = ["#1965B0", "#5289C7", "#7BAFDE", "#4EB265", "#CAE0AB"]
+        colors += ["#F7F056", "#EE8026", "#DC050C", "#72190E", "#BBBBBB"]
+        linestyles = ["-", "-", "-", "--", "--", "--", ":", ":", ":", "-"]
+    else:  #  grey is moved up to be used for ecological status of observed waterbodies
+        colors = ["#4477AA", "#66CCEE", "#228833", "#CCBB44", "#BBBBBB", "#EE6677"]
+        colors += ["#AA3377"]
+        linestyles = ["-", "--", "-.", ":", "-", "--", ":"]
+    plt.rc("axes", prop_cycle=(cycler(color=colors) + cycler(linestyle=linestyles)))
+    plt.rc("figure", figsize=[10, 6.2])  #  golden ratio
+
+
+def cv_suffix(cv="loo", downdate=False):
+    """Suffix for the names of the output files if not LOO-CV (see CV_Engine)."""
+    suffix = "" if cv == "loo" else "_" + cv
+    if downdate:
+        suffix += "_downdate"  #  approximate predictions
+    return suffix
+
+
+def plot_results(j, scores, status, label="", cv="loo", downdate=False):
+    """Bar plot of accuracy scores and line plot of the share of waterbodies with less
+    than good ecological status by year for the models selected by stepwise_selection().
+    Saved as PDFs with the same names as the CSVs, i.e., with the label and the suffix
+    for the CV mode (cv and downdate as given to stepwise_selection)."""
+    label += cv_suffix(cv, downdate)
+    # Accuracy score by year and selected predictors
+    scores.index = scores.index.astype(str)  #  convert index to string (as read_csv)
+    sco = scores.drop(columns="n").drop(["1989", "Total"], errors="ignore")
+    ax = sco.plot(
+        kind="bar", ylabel="Accuracy in predicting observed ecological status"
+    )
+    if j == "coastal":
+        ax.legend(loc="lower left")
+    f1 = ax.get_figure()
+    f1.savefig(
+        "output/" + j + "_eco_imp_accuracy" + label + ".pdf", bbox_inches="tight"
+    )
+
+    # Share with less than good ecological status by year and selected predictors
+    status.index = status.index.astype(str)  #  convert index to string (as read_csv)
+    status_years = status.drop(["1989", "Total"], errors="ignore")  #  account years
+    imp = status_years.drop(columns=["n", "Obs"])  #  imputed status by selected models
+    obs = status_years[["Obs"]]  #  ecological status of waterbodies observed that year
+    obs.columns = ["Observed"]  #  rename 'Obs' to 'Observed'
+    sta = imp.merge(obs, left_index=True, right_index=True)  #  add Observed last
+    f2 = sta.plot(  #  plot share with less than good ecological status
+        ylabel="Share of "
+        + categories[j]["label"]
+        + " with less than good ecological status"
+    ).get_figure()
+    f2.savefig(
+        "output/" + j + "_eco_imp_LessThanGood" + label + ".pdf", bbox_inches="tight"
+    )
+
+
+def main():
+    """Command-line entry point, e.g., run from the gis folder:
+    python CV_module.py streams --subset sparse --backend processes --n_jobs -1"""
+    parser = argparse.ArgumentParser(
+        description="Forward stepwise selection of dummies for the imputation of "
+        "ecological status, scored by cross-validation (CV)."
+    )
+    parser.add_argument("category", choices=list(categories))
+    parser.add_argument(
+        "--subset",
+        choices=["all", "sparse"],
+        default="all",
+        help="CV over all observed values or over waterbodies observed at most "
+        "max_obs times (CSV names get the label _sparse)",
+    )
+    parser.add_argument(
+        "--max_obs", type=int, help="default: 3 for streams and 4 for lakes"
+    )
+    parser.add_argument(
+        "--dummies", nargs="+", help="candidate dummies (default: all for category)"
+    )
+    parser.add_argument(
+        "--select_all",
+        action="store_true",
+        help="include the dummies in the order listed instead of stepwise selection",
+    )
+    parser.add_argument(
+        "--backend", choices=["serial", "threads", "processes"], default="processes"
+    )
+    parser.add_argument("--n_jobs", type=int, default=-1, help="-1 uses all cores")
+    parser.add_argument(
+        "--cv",
+        choices=["loo", "kfold", "waterbody", "year"],
+        default="loo",
+        help="CSV and PDF names get the suffix cv; year requires --subset sparse",
+    )
+    parser.add_argument("--k", type=int, default=10, help="number of folds")
+    parser.add_argument(
+        "--checkpoint",
+        help="CSV to resume from (default: output/category_eco_imp_checkpoint.csv)",
+    )
+    parser.add_argument(
+        "--downdate", action="store_true", help="replay the full fit (approximation)"
+    )
+    parser.add_argument(
+        "--imputer",
+        choices=["chained", "soft", "als"],
+        default="chained",
+        help="chained equations or low-rank matrix completion by soft-impute or ALS "
+        "(CSV names get the label _soft or _als)",
+    )
+    parser.add_argument(
+        "--racing",
+        type=float,
+        help="share of the cells in the first sample to race the candidates on",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="confidence for dropping a candidate when racing",
+    )
+    parser.add_argument(
+        "--rescore",
+        action="store_true",
+        help="score the stored predictions instead of running CV (see rescore)",
+    )
+    parser.add_argument(
+        "--thresholds",
+        nargs="+",
+        type=float,
+        default=[0.5, 1.5, 2.5],
+        help="thresholds between categories of ecological status for --rescore",
+    )
+    parser.add_argument("--years", nargs=2, type=int, default=[1989, 2020])
+    parser.add_argument(
+        "--path",
+        default=os.path.dirname(os.path.abspath(__file__)),
+        help="folder with the output folder (default: folder of this module)",
+    )
+    args = parser.parse_args()
+    j = args.category
+
+    # Read the data from the output folder
+    os.chdir(args.path)
+    dfEcoObs, dfVP = load_data(j)
+    years = list(range(args.years[0], args.years[1] + 1))
+
+    # Merge DataFrames for ecological status (observed and basis analysis for VP3)
+    dfObs = dfEcoObs.merge(dfVP[["Basis"]], on="wb")
+
+    # Subset of waterbodies to perform CV over
+    if args.subset == "sparse":
+        max_obs = args.max_obs or categories[j]["sparse"]
+        if max_obs is None:
+            parser.error("--max_obs is required for a sparse subset of " + j)
+        nObs = dfEcoObs.notna().sum(axis=1)
+        subset = dfEcoObs[(nObs >= 1) & (nObs <= max_obs)]
+        label = "_sparse"
+    else:
+        subset, label = dfEcoObs, ""
+    if args.cv == "year" and args.subset != "sparse":
+        parser.error(
+            "--cv year holds out every observed value of a year; use --subset sparse"
+        )
+    if args.imputer != "chained":
+        if args.downdate:
+            parser.error("--downdate requires --imputer chained")
+        label += "_" + args.imputer  #  benchmark of a low-rank imputer
+
+    # Score the stored predictions with other thresholds without refitting
+    if args.rescore:
+        name = (
+            "output/" + j + "_eco_imp_{0}" + label + cv_suffix(args.cv, args.downdate)
+        )
+        tables = rescore(name.format("predictions") + ".parquet", args.thresholds)
+        for a, b in zip(tables, ["accuracy", "confusion", "LessThanGood"]):
+            a.to_csv(name.format("rescore_" + b) + ".csv")
+            print(a)
+        return
+
+    # Imputer with the maximum number of rounds used for the category
+    if args.imputer == "chained":
+        imputer = imputation_module.Chained_Imputer(
+            tol=1e-1, max_iter=categories[j]["max_iter"]
+        )
+        engine = ""
+    else:  #  low-rank matrix completion (see imputation_module.py)
+        imputer = imputation_module.Low_Rank_Imputer(args.imputer)
+        engine = "_" + args.imputer  #  keep the predictions of each imputer apart
+    checkpoint = (
+        args.checkpoint or "output/" + j + "_eco_imp_checkpoint" + engine + ".csv"
+    )
+
+    selected, scores, status = stepwise_selection(
+        j,
+        subset,
+        args.dummies or categories[j]["dummies"],
+        dfObs,
+        typology(j, dfVP),
+        years,
+        imputer,
+        label,
+        args.select_all,
+        args.n_jobs,
+        args.backend,
+        args.cv,
+        args.k,
+        checkpoint,
+        args.downdate,
+        args.racing,
+        args.confidence,
+    )
+    print("Selected dummies:", selected)
+    print(scores)
+    print(status)
+    set_style(j)
+    plot_results(j, scores, status, label, args.cv, args.downdate)
+
+
+if __name__ == "__main__":
+    main()
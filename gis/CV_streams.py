@@ -10,211 +10,45 @@ Usage:      This is a standalone script that only serves to evaluates the robust
             which supports WaterbodiesScriptTool in the gis.tbx toolbox.
             See GitHub.com/ThorNoe/GreenGDP for instructions to run or update it all.
 
+            Run the script from the gis folder (the working directory must contain the
+            output folder). The cross-validation in step 2 can also be run from the
+            command line using CV_module.py, e.g., python CV_module.py streams --help
+
 License:    MIT Copyright (c) 2024
 Author:     Thor Donsby Noe 
 """
 
 ########################################################################################
-#   0. Functions
+#   0. Imports and settings
 ########################################################################################
-import os
-
-import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
-import tqdm
-from cycler import cycler
-from sklearn.experimental import enable_iterative_imputer  # noqa
-from sklearn.impute import IterativeImputer
-from sklearn.metrics import accuracy_score
+
+import CV_module
+import imputation_module
 
 # Iterative imputer using the BayesianRidge() estimator with increased tolerance
-imputer = IterativeImputer(tol=1e-1, max_iter=100, random_state=0)
-
-# Color-blind-friendly color scheme for qualitative data by Tol: personal.sron.nl/~pault
-colors = {
-    "blue": "#4477AA",
-    "cyan": "#66CCEE",
-    "green": "#228833",
-    "yellow": "#CCBB44",
-    "grey": "#BBBBBB",  #  moved up to be used for ecological status of observed streams
-    "red": "#EE6677",
-    "purple": "#AA3377",
-}
-
-# Set the default property-cycle and figure size for pyplots
-color_cycler = cycler(color=list(colors.values()))  #  color cycler with 7 colors
-linestyle_cycler = cycler(linestyle=["-", "--", "-.", ":", "-", "--", ":"])  #  7 styles
-plt.rc("axes", prop_cycle=(color_cycler + linestyle_cycler))  #  set color and linestyle
-plt.rc("figure", figsize=[10, 6.2])  #  golden ratio
-
-
-# Function for accuracy score of predicted fauna class
-def AccuracyScore(y_true, y_pred):
-    """Convert continuous prediction of ecological status to categorical index and return accuracy score, i.e., the share of observed lakes each year where predicted ecological status matches the true ecological status (which LOO-CV omits from the dataset before applying imputation)."""
-    eco_true, eco_pred = [], []  #  empy lists for storing transformed observations
-    for a, b in zip([y_true, y_pred], [eco_true, eco_pred]):
-        # Demarcation for categorical ecological status: Bad, Poor, Moderate, Good, High
-        conditions = [
-            a < 0.5,  # Bad
-            (a >= 0.5) & (a < 1.5),  #  Poor
-            (a >= 1.5) & (a < 2.5),  #  Moderate
-            a >= 2.5,  #  Good or High
-        ]
-        b.append(np.select(conditions, [0, 1, 2, 3], default=np.nan))  #  add to list
-    return accuracy_score(eco_true[0], eco_pred[0])
-
-
-def stepwise_selection(subset, dummies, data, dfDummies, years, select_all=False):
-    """Forward stepwise selection of predictors p to include in the model."""
-    predictors = ["No dummies"] + dummies  #  list of possible predictors to include
-    selected = []  #  empty list for storing selected predictors
-    current_score, best_new_score = 0.0, 0.0  #  initial scores
-    prefixes = ["streams_eco_imp_accuracy", "streams_eco_imp_LessThanGood"]  # CSV names
-
-    # DataFrame for storing accuracy scores by year and calculating weighted average
-    scores = pd.DataFrame(subset.count(), index=years, columns=["n"]).astype(int)
-    scores.loc["Total", "n"] = np.nan  #  row to calculate weighted average of scores
-    scores_all = scores.copy()  #  scores for all sets of predictors being tested
-
-    # DataFrame for storing ecological status by year and calculating weighted average
-    status = scores.copy()  #  likewise, covers the years in the natural capital account
-    status["Obs"] = (subset[years] < 2.5).sum() / status["n"]  #  eco status < good
-    status.loc["Total", "Obs"] = (status["Obs"] * status["n"]).sum() / status["n"].sum()
-    status_all = status.copy()  #  eco status for all sets of predictors being tested
-
-    while current_score == best_new_score:
-        names = []  #  empty list for storing model names
-        scores_total = []  #  empty list for storing total score for each predictor
-        sco = scores[["n"]].copy()  #  df for calculating weighted average of scores
-        sta = status[["n"]].copy()  #  df for calculating weighted average of status
-
-        for p in predictors:
-            if p == "No dummies":  #  baseline model without any dummies
-                df = data.copy()  #  df without predictors
-                df.name = "No dummies"  #  name baseline model
-            else:
-                predictors_used = selected + [p]  #  selected predictors remain in model
-                df = data.merge(dfDummies[predictors_used], on="wb")  #  with predictors
-                df.name = ", ".join(predictors_used)  #  name model after its predictors
-            names.append(df.name)  #  add model name to list of model names
-
-            # Estimate share with less than good ecological status
-            dfImp = pd.DataFrame(
-                imputer.fit_transform(np.array(df)), index=df.index, columns=df.columns
-            )
-
-            # Subset to the waterbodies included in the subset and drop predictors
-            dfImpSubset = dfImp.loc[subset.index, subset.columns]
-
-            # Predicted share with less than good ecological status for relevant years
-            sta[df.name] = (dfImpSubset[years] < 2.5).sum() / len(subset)
-
-            # loop over each year t and waterbody i in (subset of) observed waterbodies
-            for t in tqdm.tqdm(years):  #  time each model and report progress in years
-                y = subset[subset[t].notnull()].index  #  index for LOO-CV at year t
-                Y = pd.DataFrame(index=y)  #  empty df for observed and predicted values
-                Y["true"] = df.loc[y, t]  #  column with the observed ('true') values
-                Y["pred"] = pd.NA  #  empty column for storing predicted values
-                for i in y:  #  loop over each observed value at year t
-                    X = df.copy()  #  use a copy of the given DataFrame
-                    X.loc[i, t] = pd.NA  #  set the observed value as missing
-                    # Fit imputer and transform the dataset
-                    X_imp = pd.DataFrame(
-                        imputer.fit_transform(np.array(X)),
-                        index=X.index,
-                        columns=X.columns,
-                    )
-                    Y.loc[i, "pred"] = X_imp.loc[i, t]  #  store predicted value
-
-                # Accuracy of predicted ecological status
-                accuracy = AccuracyScore(Y["true"], Y["pred"])
-
-                # Save accuracy score each year to DataFrame for scores
-                sco.loc[t, df.name] = accuracy
-
-            # Total accuracy weighted by number of observations used for LOO-CV each year
-            for a, b in zip([scores_all, status_all], [sco, sta]):
-                b.loc["Total", df.name] = (b[df.name] * b["n"]).sum() / b["n"].sum()
-                a[df.name] = b[df.name]  #  scores & status by year for all predictors
-            scores_total.append(sco.loc["Total", df.name])  #  score for each predictor
-
-            print(df.name, "used for imputation. Accuracy score:", scores_total[-1])
-
-            if p == "No dummies":
-                break  #  save baseline model before stepwise selection of dummies
-
-            elif select_all is True:
-                break  #  proceed to select every predictor in the order they are listed
-
-        best_new_score = max(scores_total)  #  best accuracy score among predictors
-
-        if select_all is True:
-            current_score = best_new_score  #  update current score to continue process
-
-            # Move the given dummy from the list of predictors to the list of selected
-            selected.append(predictors.pop(0))
-
-            # Save scores and status by year for every set of predictors
-            for a, b, c in zip([scores, status], [scores_all, status_all], prefixes):
-                a[names[-1]] = b[names[-1]]  #  scores & status by year for predictor
-                b.to_csv("output/" + c + ".csv")  # overwrite CSV
-
-        elif best_new_score > current_score:
-            current_score = best_new_score  #  update current score
-            i = scores_total.index(best_new_score)  #  index for predictor w. best score
-
-            # Move dummy with the best new score from the list of predictors to selected
-            selected.append(predictors.pop(i))
-
-            # # Save scores and status by year subject to the selected set of predictors
-            for a, b, c in zip([scores, status], [sco, sta], prefixes):
-                a[names[i]] = b[names[i]]  #  scores & status by year for best predictor
-                a.to_csv("output/" + c + "_sparse.csv")  # overwrite CSV
-
-            # Save scores and status by year for every set of predictors
-            for a, b in zip([scores_all, status_all], prefixes):
-                a.to_csv("output/" + b + "_sparse_all.csv")  # overwrite CSV
-
-        else:  #  if best_new_score == current_score (i.e., identical accuracy score)
-            break  #  stop selection (including the predictor would increase variance)
-
-        if p == "No dummies":
-            selected = []  #  after baseline model, start actual stepwise selection
-
-        elif predictors == []:  #  if all predictors have been included
-            break  #  stop stepwise selection
-
-    # Total number of observations that LOO-CV was performed over
-    for s in (scores, status, scores_all, status_all):
-        s.loc["Total", "n"] = s["n"].sum()
-
-    # Overwrite CSV of accuracy scores and share with less than good ecological status
-    if subset is sparse:
-        scores.to_csv("output/streams_eco_imp_accuracy_sparse.csv")
-        status.to_csv("output/streams_eco_imp_LessThanGood_sparse.csv")
-        scores_all.to_csv("output/streams_eco_imp_accuracy_sparse_all.csv")
-        status_all.to_csv("output/streams_eco_imp_LessThanGood_sparse_all.csv")
-    else:
-        scores.to_csv("output/streams_eco_imp_accuracy.csv")
-        status.to_csv("output/streams_eco_imp_LessThanGood.csv")
+# from sklearn.experimental import enable_iterative_imputer  # noqa
+# from sklearn.impute import IterativeImputer
+# imputer = IterativeImputer(tol=1e-1, max_iter=100, random_state=0)
 
-    return selected, scores, status  #  selected predictors; scores and stats by year
+# Same imputations within numerical precision, but faster (see imputation_module.py)
+imputer = imputation_module.Chained_Imputer(tol=1e-1, max_iter=100)
+
+# Low-rank matrix completion, faster for very large panels (see imputation_module.py)
+# imputer = imputation_module.Low_Rank_Imputer("als", rank=3)
+
+# Set the default property-cycle and figure size for pyplots (see CV_module.py)
+CV_module.set_style("streams")
 
 
 ########################################################################################
 #   1. Data setup
 ########################################################################################
-# Specify the working directory of the operating system
-os.chdir(r"C:\Users\au687527\GitHub\GreenGDP\gis")
-
 # Limit LOO-CV to loop over years used directly for the natural capital account
 years = list(range(1989, 2020 + 1))
 
 # Read DataFrames for observed ecological status and typology
-dfEcoObs = pd.read_csv("output/streams_eco_obs.csv", index_col="wb")
-dfEcoObs.columns = dfEcoObs.columns.astype(int)
-dfVP = pd.read_csv("output\\streams_VP.csv", index_col="wb")
+dfEcoObs, dfVP = CV_module.load_data("streams")
 
 # Share of waterbodies by number of non-missing values
 for n in range(0, len(dfEcoObs.columns) + 1):
@@ -228,38 +62,9 @@ sparse.count().sum()  #  5419 non-missing values in total to loop over with LOO-
 # Merge DataFrames for ecological status (observed and basis analysis for VP3)
 dfObs = dfEcoObs.merge(dfVP[["Basis"]], on="wb")
 
-# Create dummies for typology
-typ = pd.get_dummies(dfVP["ov_typ"]).astype(int)
-typ["Soft bottom"] = typ["RW4"] + typ["RW5"]
-typ.columns = [
-    "Small",
-    "Medium",
-    "Large",
-    "Small w. soft bottom",
-    "Medium w. soft bottom",
-    "Soft bottom",  #  only 1 out of 261 streams in basis analysis but it's not observed
-]
-
-# List dummies for typology
-cols = ["Small", "Medium", "Large", "Soft bottom"]
-
-# Merge DataFrames for typology and observed biophysical indicator
-dfTypology = dfObs.merge(typ[cols], on="wb")
-
-# Create dummies for natural, artificial, and heavily modified waterbodies
-natural = pd.get_dummies(dfVP["na_kun_stm"]).astype(int)
-natural.columns = ["Artificial", "Natural", "Heavily modified"]
-
-# Merge DataFrames for typology and natural waterbodies
-dfNatural = dfTypology.merge(natural["Natural"], on="wb")
-cols.append("Natural")  #  add to list of dummies
-
-# Create dummies for waterbody district
-distr = pd.get_dummies(dfVP["distr_id"]).astype(int)
-
-# Extend dfNatural with dummy for district DK2 (Sealand, Lolland, Falster, and Møn)
-dfDistrict = dfNatural.merge(distr["DK2"], on="wb")
-cols.append("DK2")
+# Dummies for typology, natural waterbodies, and district DK2 (see CV_module.py)
+cols = ["Small", "Medium", "Large", "Soft bottom", "Natural", "DK2"]
+dfDistrict = dfObs.merge(CV_module.typology("streams", dfVP)[cols], on="wb")
 
 # Soft-bottom streams are not covered by the basis analysis
 dfDistrict["Soft bottom"].eq(1).sum()  #  261 soft-bottom streams
@@ -334,6 +139,7 @@ for a, b in zip([VPstats, VPbasis], ["VP_stats", "VP_basis"]):
 #   2. Subset selection (note: CV takes ~30hours for sparse + ~54h for all observations)
 ########################################################################################
 # # Example data for testing Forward Stepwise Selection with LOO-CV (takes ~5 seconds)
+# import numpy as np
 # dfEcoObs = pd.DataFrame(
 #     {
 #         1988: [0.5, 1.0, 1.5, 2.0, np.nan, 3.0],
@@ -355,15 +161,21 @@ for a, b in zip([VPstats, VPbasis], ["VP_stats", "VP_basis"]):
 # years = list(range(1989, 1993 + 1))
 
 # Forward stepwise selection of dummies - CV over subset of sparsely observed streams
-kwargs = {"data": dfObs, "dfDummies": dfDistrict, "years": years}  #  shared arguments
-selectedSparse, scoresSparse, statusSparse = stepwise_selection(
-    subset=sparse, dummies=cols, **kwargs
+kwargs = {"j": "streams", "data": dfObs, "dfDummies": dfDistrict, "years": years}
+kwargs["imputer"] = imputer  #  shared arguments
+kwargs["n_jobs"] = -1  #  fan the CV fits out over all cores (same results as serial)
+kwargs["backend"] = "threads"  #  no worker processes to spawn (safe on Windows)
+# kwargs["cv"] = "kfold"  #  10-fold CV instead of LOO-CV takes minutes instead of days
+kwargs["checkpoint"] = "output/streams_eco_imp_checkpoint.csv"  #  resume if interrupted
+# kwargs["downdate"] = True  #  replay the full fit instead of refitting (approx.)
+selectedSparse, scoresSparse, statusSparse = CV_module.stepwise_selection(
+    subset=sparse, dummies=cols, label="_sparse", **kwargs
 )
 scoresSparse
 statusSparse
 
 # Selection of dummies from the dummies selected above - CV over all observed values
-selected, scores, status = stepwise_selection(
+selected, scores, status = CV_module.stepwise_selection(
     subset=dfEcoObs, dummies=selectedSparse, select_all=True, **kwargs
 )
 scores
@@ -377,22 +189,7 @@ status
 # scores = pd.read_csv("output/streams_eco_imp_accuracy.csv", index_col=0)
 # status = pd.read_csv("output/streams_eco_imp_LessThanGood.csv", index_col=0)
 
-# Accuracy score by year and selected predictors
-scores.index = scores.index.astype(str)  #  convert index to string (to mimic read_csv)
-sco = scores.drop(columns="n").drop(["1989", "Total"])  #  subset to relevant years
-f1 = sco.plot(  #  bar plot accuracy scores
-    kind="bar", ylabel="Accuracy in predicting observed ecological status"
-).get_figure()
-f1.savefig("output/streams_eco_imp_accuracy.pdf", bbox_inches="tight")  #  save PDF
-
-# Share of streams with less than good ecological status by year and selected predictors
-status.index = status.index.astype(str)  #  convert index to string (to mimic read_csv)
-status_years = status.drop(["1989", "Total"])  #  cover years in natural capital account
-imp = status_years.drop(columns=["n", "Obs"])  #  imputed status by selected predictors
-obs = status_years[["Obs"]]  #  ecological status of streams observed the given year
-obs.columns = ["Observed"]  #  rename 'Obs' to 'Observed'
-sta = imp.merge(obs, left_index=True, right_index=True)  #  add Observed as last column
-f2 = sta.plot(  #  plot share of streams with less than good ecological status
-    ylabel="Share of streams with less than good ecological status"
-).get_figure()
-f2.savefig("output/streams_eco_imp_LessThanGood.pdf", bbox_inches="tight")  #  save PDF
+# Bar plot of accuracy scores and plot of share with less than good ecological status
+# Same suffix for the CV mode as the CSVs, e.g., "_kfold" (none for LOO-CV)
+mode = {"cv": kwargs.get("cv", "loo"), "downdate": kwargs.get("downdate", False)}
+CV_module.plot_results("streams", scores, status, **mode)  #  save to PDFs
@@ -0,0 +1,431 @@
+"""
+Name:       imputation_module.py
+
+Label:      Impute missing values by chained equations using Bayesian ridge regressions.
+
+Summary:    ThorNoe.GitHub.io/GreenGDP explains the overall approach and methodology.
+
+Usage:      This module supports impute_missing() in script_module.py and the CV scripts
+            as a fast drop-in replacement for IterativeImputer(tol=1e-1, max_iter=100)
+            from scikit-learn with its default BayesianRidge() estimator.
+
+            The imputer gives the same imputations within numerical precision because
+            it follows the same steps: initial imputation by the mean of each column,
+            rounds over the columns in ascending order of missing values, where each
+            column is regressed on all other columns using the rows where it is
+            observed, and the same stopping rule for the rounds. The regressions use
+            the sufficient statistics (Gram matrix, sums, and number of rows) of each
+            column rather than the data. These are updated incrementally whenever the
+            imputed values of a column change, so a round costs one matrix product per
+            column instead of refitting each regression from scratch.
+
+            For leave-one-out CV, held_out() predicts observed cells as if they were
+            missing by replaying the rounds of the fit on the full data for the rows
+            with held-out cells only, using rank-one downdates and updates of the
+            statistics of each regression. The other rows keep their imputed values
+            from the full data, so the predictions deviate from exact refits, the more
+            so the fewer waterbodies (see check() in CV_module.py). The rounds are only
+            kept by a fit with keep_path=True (as set by CV_module.py for downdates).
+
+            As an alternative for very large panels (more years or waterbodies), the
+            Low_Rank_Imputer completes the matrix of ecological status by a low-rank
+            matrix with the complete columns (the dummies) as covariates: each round
+            regresses the imputed data on the dummies and fits the residuals by either
+            a soft-thresholded SVD (soft-impute) or alternating ridge regressions of
+            the factors (ALS). A round costs a few matrix products, i.e., linear in the
+            number of waterbodies. In 10-fold CV (accuracy score of CV_module.py), ALS
+            of rank 3 scores 0.74 for streams, 0.50 for lakes, and 0.66 for coastal
+            waters vs. 0.75, 0.41, and 0.58 for the chained equations.
+
+            The fitted imputations are saved next to the outputs by impute_missing()
+            (e.g., output/streams_eco_imp_chained.npz). Optionally (warm=True), the next
+            fit starts from the saved imputations (warm start) rather than the means,
+            which takes fewer rounds. As the rounds stop at a tolerance, a warm fit
+            barely moves from its start, so the imputations depend on the starting
+            point. Hence, a warm fit and a fit from scratch are first compared on a
+            sample of the rows, and the data is fitted from scratch if they differ by
+            more than a tolerance on average. The comparison errs on the side of a
+            refit, as the fit from scratch of a sample uses fewer rows than the saved
+            fit (e.g., for streams with 2020 added, it gives 0.14, while the warm and
+            cold fits of all rows differ by 0.03). Fits start from scratch by default.
+
+Functions:  The Chained_Imputer class in this module contains 5 functions:
+            - fit_transform() imputes the missing values, which calls:
+                - sweep(), which calls:
+                    - regression()
+                    - update_stats()
+            - held_out() predicts held-out cells from the fit, which calls:
+                - regression()
+            Besides, bayesian_ridge() fits the regression from sufficient statistics.
+            The Low_Rank_Imputer class contains 2 functions:
+            - fit_transform() imputes the missing values, which calls:
+                - low_rank() for the residuals in each round
+            Also, save_fit() and warm_start() keep the fit for the next run, and drift()
+            compares a warm-started fit with a fit from scratch on a sample of rows.
+
+License:    MIT Copyright (c) 2025
+Author:     Thor Donsby Noe
+"""
+
+import copy
+import os
+import warnings
+
+import numpy as np
+from scipy import sparse
+from sklearn.exceptions import ConvergenceWarning
+
+
+def bayesian_ridge(G, Xty, yty, n, max_iter=300, tol=1e-3):
+    """Fit BayesianRidge() from scikit-learn (default hyper-parameters) given the
+    centered Gram matrix G = X'X, cross products Xty = X'y, and yty = y'y of n rows.
+    Returns the coefficients of the regression (without the intercept)."""
+    eps = np.finfo(np.float64).eps
+    alpha, lamb = 1.0 / (yty / n + eps), 1.0  #  initial precisions of noise and weights
+    a1 = a2 = l1 = l2 = 1e-6  #  shape and rate parameters of the Gamma priors
+
+    # Eigendecomposition of X'X equals the squared singular values of X
+    eig, V = np.linalg.eigh(G)
+    eig = np.clip(eig, 0, None)  #  remove negative round-off errors
+    z = V.T @ Xty  #  cross products in the basis of eigenvectors
+
+    # Evidence maximization (same steps as BayesianRidge.fit) in the eigenbasis
+    bOld = None
+    for iter in range(max_iter):
+        b = z / (eig + lamb / alpha)  #  coefficients in the eigenbasis
+        sse = max(yty - 2 * b @ z + b @ (eig * b), 0)  #  sum of squared errors
+        gamma = np.sum((alpha * eig) / (lamb + alpha * eig))
+        lamb = (gamma + 2 * l1) / (b @ b + 2 * l2)
+        alpha = (n - gamma + 2 * a1) / (sse + 2 * a2)
+        if iter != 0 and np.sum(np.abs(V @ (bOld - b))) < tol:
+            break
+        bOld = b
+    return V @ (z / (eig + lamb / alpha))
+
+
+def save_fit(path, index, columns, Xt):
+    """Save the imputed 2D array Xt with the labels of its rows (index, e.g., the
+    waterbody IDs) and columns (e.g., years, Basis, and dummies) at path (.npz)."""
+    with open(path + "_temp", "wb") as file:
+        np.savez(
+            file,
+            index=np.asarray(index, dtype=np.int64),
+            columns=np.array([str(c) for c in columns]),
+            imputed=np.asarray(Xt, dtype=np.float64),
+        )
+    os.replace(path + "_temp", path)  #  write to a temporary file first
+
+
+def warm_start(path, index, columns):
+    """Initial imputations for a fit with the given rows (index) and columns from the
+    fit saved at path (see save_fit), where new rows and columns are NaN (imputed by
+    the mean). Returns None if there is no saved fit."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as saved:
+        rowsSaved = {k: r for r, k in enumerate(saved["index"].tolist())}
+        colsSaved = {k: c for c, k in enumerate(saved["columns"].tolist())}
+        Xt = saved["imputed"]
+    rows = np.array([rowsSaved.get(k, -1) for k in np.asarray(index).tolist()])
+    cols = np.array([colsSaved.get(str(k), -1) for k in columns])
+    init = np.full((len(rows), len(cols)), np.nan)
+    r, c = rows >= 0, cols >= 0
+    init[np.ix_(r, c)] = Xt[np.ix_(rows[r], cols[c])]
+    return init
+
+
+def drift(imputer, X, init, share=0.2, random_state=0):
+    """Mean absolute difference between a fit that starts from the saved imputations
+    (init, see warm_start) and a fit from scratch over the imputed cells of a random
+    sample of rows (share) of the data X. Unlike the change from init, this does not
+    depend on how close to init the warm fit stops, i.e., it indicates how far a warm
+    fit of X is from a fit from scratch at a fraction of the cost of the latter. It
+    tends to overstate this, as a fit from scratch of fewer rows differs more."""
+    X = np.asarray(X, dtype=np.float64)
+    rng = np.random.default_rng(random_state)
+    size = min(len(X), max(int(share * len(X)), 100))  #  at least 100 rows
+    rows = np.sort(rng.choice(len(X), size, replace=False))
+    sample = X[rows]
+    cold = copy.copy(imputer).fit_transform(sample)
+    warm = copy.copy(imputer).fit_transform(sample, init[rows])
+    cells = np.isnan(sample)[:, ~np.all(np.isnan(sample), axis=0)]  #  imputed cells
+    return np.abs(warm - cold)[cells].mean() if cells.any() else 0.0
+
+
+class Chained_Imputer:
+    """Imputer by chained equations that keeps the sufficient statistics of each regression"""
+
+    def __init__(self, tol=1e-1, max_iter=100, random_state=None, keep_path=False):
+        """Same parameters as IterativeImputer. The imputer is deterministic, so
+        random_state is only accepted for compatibility. With keep_path=True, the fit
+        keeps the imputed data and the statistics of every round for held_out()."""
+        self.tol = tol
+        self.max_iter = max_iter
+        self.random_state = random_state
+        self.keep_path = keep_path
+
+    def fit_transform(self, X, init=None):
+        """Impute the missing values (NaN) of the 2D array X. Like IterativeImputer,
+        columns without any observed values are dropped.
+
+        init is an optional warm start, i.e., a 2D array of initial imputations of the
+        same shape as X (e.g., from an earlier fit), where the cells that are NaN in
+        init are initially imputed by the mean of the column."""
+        X = np.array(X, dtype=np.float64)
+        missing = np.isnan(X)
+        valid = ~np.all(missing, axis=0)  #  drop columns without observed values
+        X, missing = X[:, valid], missing[:, valid]
+
+        # Initial imputation by the mean of each column (or by init if given)
+        Xt = np.where(missing, np.nanmean(X, axis=0), X)
+        if init is not None:
+            init = np.asarray(init, dtype=np.float64)[:, valid]
+            Xt = np.where(missing & ~np.isnan(init), init, Xt)
+        if self.max_iter == 0 or np.all(missing):
+            self.n_iter_ = 0
+            return Xt
+
+        # Impute the columns in ascending order of missing values (ignore complete)
+        order = np.argsort(missing.mean(axis=0), kind="mergesort")
+        self.targets = [c for c in order if missing[:, c].any()]
+        self.k = {c: k for k, c in enumerate(self.targets)}  #  position of each target
+        self.position = np.full(X.shape[1], -1)  #  complete columns do not change
+        self.position[self.targets] = np.arange(len(self.targets))
+        self.Xt, self.missing = Xt, missing
+
+        # Sufficient statistics of the rows where each target column is observed
+        obs = ~missing[:, self.targets]  #  rows by targets
+        self.n = obs.sum(axis=0)
+        self.s = obs.T @ Xt  #  sums of all columns by target
+        self.S = np.array([Xt[o].T @ Xt[o] for o in obs.T])  #  Gram matrices
+
+        # Rows where each target is missing but observed for at least one target, and
+        # their observed targets as a sparse matrix (each row is observed in few years)
+        obsSparse = sparse.csr_matrix(obs, dtype=np.float64)
+        anyObs = obs.any(axis=1)
+        self.rows, self.obs = {}, {}
+        for c in self.targets:
+            self.rows[c] = np.flatnonzero(missing[:, c] & anyObs)
+            self.obs[c] = obsSparse[self.rows[c]].T.tocsr()
+
+        # Rounds over the columns until the largest change is small (same as sklearn)
+        self.maxAbs = np.max(np.abs(X[~missing]))  #  scale of the stopping rule
+        if self.keep_path:
+            self.path = [Xt.copy()]  #  imputed data after each round (for held_out)
+            self.pathS, self.pathS1, self.changes = [], [], []  #  statistics, changes
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            previous = Xt.copy()
+            self.sweep()
+            change = np.abs(Xt - previous).sum(axis=1)  #  absolute change by row
+            if self.keep_path:
+                self.path.append(Xt.copy())
+                self.changes.append(change)
+            if change.max() < self.tol * self.maxAbs:  #  max row sum (inf-norm)
+                break
+        else:
+            warnings.warn(
+                "[Chained_Imputer] Early stopping criterion not reached.",
+                ConvergenceWarning,
+            )
+        return Xt
+
+    def held_out(self, i, t):
+        """Predict the observed cells in rows i and columns t as if they were missing,
+        i.e., approximate fit_transform() on the data without these observed values.
+
+        Instead of refitting from scratch, the rounds of the latest fit_transform() are
+        replayed for the rows R with held-out cells only. Each regression starts from
+        the statistics of the full data at that point and is corrected for the rows R:
+        rank-one downdates remove their values in the full data (including the
+        held-out values) and rank-one updates add their values in the replay. All
+        other rows keep the imputed values of the full data. After the rounds of the
+        full data, the replay continues with the final statistics until the stopping
+        rule is met for the rows R. Nothing is written to the fit, so threads can call
+        held_out() on the same fit at once. Requires a fit with keep_path=True."""
+        if not self.keep_path:
+            raise ValueError("held_out() requires a fit with keep_path=True")
+        i, t = np.asarray(i), np.asarray(t)
+        if not all(c in self.k for c in t):
+            # Columns without missing values in the full data are not regressed, refit
+            X = np.where(self.missing, np.nan, self.path[0])
+            X[i, t] = np.nan
+            return Chained_Imputer(self.tol, self.max_iter).fit_transform(X)[i, t]
+
+        R, pos = np.unique(i, return_inverse=True)  #  rows with held-out cells
+        missR = self.missing[R]
+        missR[pos, t] = True  #  missing values of the rows R without held-out values
+        obsR, obsR0 = ~missR[:, self.targets], ~self.missing[R][:, self.targets]
+        nR = obsR.sum(axis=0) - obsR0.sum(axis=0)  #  change in observed rows by target
+
+        # Stopping rule and initial imputation (means) without the held-out values
+        X0 = self.path[0]
+        maxAbs = self.maxAbs
+        if np.any(np.abs(X0[i, t]) == maxAbs):  #  a held-out value sets the scale
+            observed = ~self.missing
+            observed[i, t] = False
+            maxAbs = np.max(np.abs(X0[observed]))
+        xR = X0[R].copy()
+        for c in np.unique(t):
+            col = ~self.missing[:, c]
+            col[i[t == c]] = False
+            xR[missR[:, c], c] = np.mean(X0[col, c])
+
+        # Order of imputation given the shares of missing values (same as a refit)
+        nMissing = self.missing.sum(axis=0) + np.bincount(t, minlength=X0.shape[1])
+        order = [c for c in np.argsort(nMissing, kind="mergesort") if c in self.k]
+
+        others = np.isin(np.arange(len(X0)), R, invert=True)  #  rows outside R
+        for n_iter in range(1, self.max_iter + 1):  #  local, as threads share the fit
+            r = min(n_iter, self.n_iter_)  #  round of the full data
+            xPrevious = xR.copy()
+            for c in order:
+                if not missR[:, c].any():
+                    continue  #  the regression only changes rows outside R
+                k = self.k[c]
+
+                # Values of the rows R in the full data when column c was imputed
+                done = self.position[c] > self.position  #  columns imputed before c
+                x0 = np.where(done, self.path[r][R], self.path[r - 1][R])
+                a, b = obsR0[:, k], obsR[:, k]
+                S = self.pathS[r - 1][k] - x0[a].T @ x0[a] + xR[b].T @ xR[b]
+                s = self.pathS1[r - 1][k] - x0[a].sum(axis=0) + xR[b].sum(axis=0)
+                coef, mean = self.regression(S, s, self.n[k] + nR[k], c)
+                rows = missR[:, c]
+                xR[rows, c] = mean[c] + (xR[rows] - mean) @ coef
+
+            # Largest change across all rows (rows outside R as in the full data)
+            change = np.abs(xR - xPrevious).sum(axis=1).max()
+            if n_iter <= self.n_iter_:
+                change = max(change, self.changes[r - 1][others].max(initial=0))
+            if change < self.tol * maxAbs:
+                break
+        return xR[pos, t]
+
+    def sweep(self):
+        """Impute each target column once in turn (one round of chained equations).
+        With keep_path=True, the statistics used for each regression are kept for
+        held_out()."""
+        if self.keep_path:
+            self.pathS.append(np.empty_like(self.S))
+            self.pathS1.append(np.empty_like(self.s))
+        for k, c in enumerate(self.targets):
+            if self.keep_path:
+                self.pathS[-1][k], self.pathS1[-1][k] = self.S[k], self.s[k]
+            coef, mean = self.regression(self.S[k], self.s[k], self.n[k], c)
+            pred = mean[c] + (self.Xt - mean) @ coef
+            delta = np.where(self.missing[:, c], pred - self.Xt[:, c], 0)
+            self.update_stats(c, delta)
+            self.Xt[:, c] += delta
+
+    def regression(self, S, s, n, c):
+        """Regress column c on all other columns given the Gram matrix S, sums s, and
+        number n of the rows where c is observed. Returns the coefficients (zero for
+        column c itself) and the means of the columns."""
+        mean = s / n
+        C = S - n * np.outer(mean, mean)  #  centered Gram matrix
+        other = np.arange(len(s)) != c
+        coef = np.zeros(len(s))
+        coef[other] = bayesian_ridge(C[other][:, other], C[other, c], C[c, c], n)
+        return coef, mean
+
+    def update_stats(self, c, delta):
+        """Update the sufficient statistics of all targets when the imputed values of
+        column c change by delta (zero where observed), i.e., x += delta * e_c for each
+        row x, so x x' += delta * (e_c x' + x e_c') + delta^2 * e_c e_c'."""
+        rows, obs = self.rows[c], self.obs[c]
+        delta = delta[rows]
+        W = obs @ (delta[:, None] * self.Xt[rows])  #  targets by columns
+        self.S[:, c, :] += W
+        self.S[:, :, c] += W
+        self.S[:, c, c] += obs @ delta**2
+        self.s[:, c] += obs @ delta
+
+
+class Low_Rank_Imputer:
+    """Imputer by low-rank matrix completion with the complete columns as covariates"""
+
+    def __init__(self, method="als", rank=None, shrinkage=0.1, tol=1e-4, max_iter=100):
+        """method is "als" (alternating ridge regressions of the factors of the given
+        rank, 3 by default) or "soft" (soft-impute: soft-thresholded SVD of full rank
+        unless a rank is given). shrinkage is the penalty on the singular values
+        relative to the largest singular value of the residuals after the initial
+        imputation by the mean of each column. The rounds stop when the relative
+        change of the imputed values is below tol."""
+        if method not in ("soft", "als"):
+            raise ValueError("method must be 'soft' or 'als'")
+        self.method = method
+        self.rank = rank
+        self.shrinkage = shrinkage
+        self.tol = tol
+        self.max_iter = max_iter
+
+    def fit_transform(self, X, init=None):
+        """Impute the missing values (NaN) of the 2D array X. Like IterativeImputer,
+        columns without any observed values are dropped. init is an optional warm
+        start (see Chained_Imputer)."""
+        X = np.array(X, dtype=np.float64)
+        missing = np.isnan(X)
+        valid = ~np.all(missing, axis=0)  #  drop columns without observed values
+        X, missing = X[:, valid], missing[:, valid]
+        if init is not None:
+            init = np.asarray(init, dtype=np.float64)[:, valid]
+
+        # Covariates: an intercept and the complete columns (e.g., dummies)
+        complete = ~missing.any(axis=0)
+        C = np.column_stack([np.ones(len(X)), X[:, complete]])
+        P = np.linalg.pinv(C)  #  least squares coefficients of C are P @ Y
+
+        # Initial imputation by the mean of each column (or by init if given)
+        Y, M = X[:, ~complete], missing[:, ~complete]
+        Yt = np.where(M, np.nanmean(Y, axis=0), Y)
+        if init is not None:
+            init = init[:, ~complete]
+            Yt = np.where(M & ~np.isnan(init), init, Yt)
+        self.n_iter_ = 0
+        if self.max_iter == 0 or not M.any():
+            X[:, ~complete] = Yt
+            return X
+
+        # Penalty on the singular values relative to the initial residuals
+        R = Yt - C @ (P @ Yt)
+        self.lamb = self.shrinkage * np.linalg.norm(R, 2)
+        self.factors = None  #  factors of the low-rank part (for ALS)
+
+        # Rounds: regress on the covariates, fit the residuals by a low-rank matrix
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            self.coef = P @ Yt
+            fit = C @ self.coef
+            Z = fit + self.low_rank(Yt - fit)
+            change = np.sum((Z[M] - Yt[M]) ** 2) / max(np.sum(Yt[M] ** 2), 1e-12)
+            Yt[M] = Z[M]
+            if change < self.tol:
+                break
+        else:
+            warnings.warn(
+                "[Low_Rank_Imputer] Early stopping criterion not reached.",
+                ConvergenceWarning,
+            )
+        X[:, ~complete] = Yt
+        return X
+
+    def low_rank(self, R):
+        """Low-rank approximation of the residuals R with shrinkage of the factors."""
+        if self.method == "soft":
+            # Soft-thresholded SVD (a thin SVD costs O(n m^2) for n rows, m columns)
+            U, s, Vt = np.linalg.svd(R, full_matrices=False)
+            s = np.maximum(s - self.lamb, 0)
+            if self.rank is not None:
+                s[self.rank :] = 0
+            return (U * s) @ Vt
+
+        # Alternating ridge regressions of the factors A (rows) and B (columns)
+        k = min(self.rank or 3, *R.shape)
+        if self.factors is None:
+            U, s, Vt = np.linalg.svd(R, full_matrices=False)
+            self.factors = U[:, :k] * np.sqrt(s[:k]), Vt[:k].T * np.sqrt(s[:k])
+        A, B = self.factors
+        I = self.lamb * np.eye(k)
+        B = np.linalg.solve(A.T @ A + I, A.T @ R).T
+        A = np.linalg.solve(B.T @ B + I, B.T @ R.T).T
+        self.factors = A, B
+        return A @ B.T
@@ -0,0 +1,165 @@
+"""
+Name:       match_module.py
+
+Label:      Match monitoring stations to water bodies using a spatial index.
+
+Summary:    ThorNoe.GitHub.io/GreenGDP explains the overall approach and methodology.
+
+Usage:      This module supports observed_indicator() in script_module.py by assigning
+            the monitoring stations that are not in the linkage table to a water body in
+            the current water body plan without ArcPy.
+
+            The geometries of the water bodies are bulk-loaded into a spatial index
+            (STRtree from shapely), which is queried for all stations at once. This
+            gives the same matches as the Spatial Join in ArcGIS (JOIN_ONE_TO_MANY,
+            KEEP_COMMON, CLOSEST within the search radius) with water bodies as target
+            features: each water body is joined with its closest station within the
+            radius, where a station inside a lake or coastal water has distance zero.
+            For streams, observed_indicator() then applies the rule of the matching
+            names (location of the station and name of the stream) to the joined pairs.
+
+            The assignments are kept in a registry of station ID, water body, method
+            (linkage table, spatial, or none), and distance for each water body plan,
+            e.g., output/streams_stations_vp3e2022_vandloeb_samlet.csv. Thus, only the
+            stations that were not seen before are matched in later runs. A new version
+            of the linkage table or another radius starts a new registry. As stations
+            are matched when they are first seen, a water body can be joined with more
+            than one station (e.g., a new station that is closer than an old station).
+
+            Requires shapely 2.0 or later.
+
+            For tuning the radius, spatial_joins() gives the joins for a grid of radii
+            from one query of the spatial index with the largest radius (see
+            radius_sweep() in script_module.py).
+
+Functions:  The module contains 9 functions:
+            - spatial_join() joins the water bodies and stations, which calls:
+                - spatial_joins() for one or more radii, which calls:
+                    - within_radius() to query the spatial index for all stations at once
+            - matching_names() applies the rule of matching names for streams.
+            - waterbodies() groups the stations assigned to each water body.
+            - id_number() converts the IDs of stations and water bodies to integers.
+            - read_registry() and write_registry() keep the assignments of stations.
+
+License:    MIT Copyright (c) 2025
+Author:     Thor Donsby Noe
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+
+
+def within_radius(geometries, x, y, radius):
+    """All pairs of geometries and points (x, y) within the radius of each other and
+    their distances (zero for points inside a polygon). Returns the indices of the
+    geometries and the points and the distances as arrays."""
+    points = shapely.points(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    tree = shapely.STRtree(geometries)  #  bulk-loaded spatial index of the geometries
+    p, g = tree.query(points, predicate="dwithin", distance=radius)
+    return g, p, shapely.distance(tree.geometries[g], points[p])
+
+
+def spatial_join(wb, stations, radius=15):
+    """Join each water body with its closest station within the radius (if any).
+
+    wb is a DataFrame of the water bodies with their geometries in the column
+    'geometry' (shapely) and the other columns (e.g., ov_id and ov_navn) to keep.
+    stations is a DataFrame with columns station, x, and y (and e.g. location). Returns
+    a DataFrame with the columns of both and the Distance for each joined pair. Ties
+    in the distance are broken by the lowest station ID."""
+    return spatial_joins(wb, stations, [radius])[radius]
+
+
+def spatial_joins(wb, stations, radii):
+    """Spatial join (see above) for each radius in radii from one query of the spatial
+    index with the largest radius. Returns a dictionary of the joins by radius."""
+    valid = stations[["x", "y"]].notna().all(axis=1).to_numpy()  #  coordinates known
+    stations = stations[valid].reset_index(drop=True)
+    g, p, distance = within_radius(
+        wb["geometry"].to_numpy(), stations["x"], stations["y"], max(radii)
+    )
+
+    # Pairs of water bodies and stations sorted by distance (and station ID)
+    pairs = pd.DataFrame({"g": g, "p": p, "Distance": distance})
+    pairs["station"] = stations["station"].to_numpy()[p]
+    pairs = pairs.sort_values(["g", "Distance", "station"], kind="stable")
+
+    joins = {}
+    for r in radii:
+        # Closest station within the radius for each water body
+        closest = pairs[pairs["Distance"] <= r].drop_duplicates("g")
+
+        # Attributes of the station and water body of each pair (not the coordinates)
+        cols = [c for c in stations.columns if c not in ("x", "y")]
+        join = pd.concat(
+            [
+                stations[cols].iloc[closest["p"]].reset_index(drop=True),
+                wb.drop(columns="geometry").iloc[closest["g"]].reset_index(drop=True),
+            ],
+            axis=1,
+        )
+        join["Distance"] = closest["Distance"].to_numpy()
+        joins[r] = join
+    return joins
+
+
+def matching_names(join):
+    """Subset the joined pairs of streams and stations to the pairs where the name of
+    the stream (ov_navn) matches the location name of the station, and keep the
+    closest stream for each station. Unnamed streams do not match unnamed locations."""
+    join = join.copy()
+
+    # Capitalize water body names
+    join["ov_navn"] = join["ov_navn"].str.upper()
+
+    # Rename unnamed water bodies to distinguish from named water bodies
+    join["location"] = join["location"].mask(
+        join["location"] == "[IKKE NAVNGIVET]", "UDEN NAVN"
+    )
+
+    # Subset to unique stations with their closest matching water body
+    match = join["location"] == join["ov_navn"]
+    return (
+        join[match]
+        .sort_values("Distance", kind="stable")
+        .groupby("station", as_index=False)
+        .first()
+    )
+
+
+def waterbodies(df, assigned):
+    """Longitudinal DataFrame by water body, where multiple stations in a water body
+    are grouped by taking the median and rounding down. df is the longitudinal
+    DataFrame of the stations (with a column station) and assigned has the columns
+    station and wb (the water body ID) for the stations assigned to water bodies."""
+    assigned = assigned[["station", "wb"]].astype(int)
+    allMatches = df.merge(assigned, on="station")
+    allMatches = allMatches.drop(
+        columns=["station", "x", "y", "location"], errors="ignore"
+    )
+    return allMatches.groupby("wb").median().apply(np.floor)
+
+
+def id_number(ids):
+    """Integer number of IDs such as DKRIVER7253, DKLAKE1, or DKMONRW10000006."""
+    return ids.str.extract(r"(\d+)", expand=False).astype(int)
+
+
+def read_registry(path, version):
+    """Registry of the stations assigned to water bodies saved at path (columns
+    station, wb, method, and Distance). Returns an empty registry if there is none or
+    if it was saved for another version (e.g., of the linkage table, the layer of
+    water bodies, or the radius)."""
+    if os.path.exists(path):
+        registry = pd.read_csv(path)
+        if len(registry) > 0 and (registry["version"] == version).all():
+            return registry.drop(columns="version")
+    return pd.DataFrame(columns=["station", "wb", "method", "Distance"])
+
+
+def write_registry(registry, path, version):
+    """Save the registry of the stations assigned to water bodies at path."""
+    registry.assign(version=version).to_csv(path, index=False)
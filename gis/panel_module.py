@@ -0,0 +1,314 @@
+"""
+Name:       panel_module.py
+
+Label:      Set up longitudinal panels of biophysical indicators by station and year.
+
+Summary:    ThorNoe.GitHub.io/GreenGDP explains the overall approach and methodology.
+
+Usage:      This module supports longitudinal() in script_module.py by computing the
+            panels for all stations and years at once rather than year by year.
+
+            For lakes and coastal waters, summer_average() gives the same chlorophyll
+            summer averages as interpolating a daily DataFrame for each year: observations
+            up to 6 weeks before May 1 or after September 30 are used, gaps are linearly
+            interpolated up to 41 days from an observation (both directions), and the
+            remaining gaps in May-September are linearly interpolated without limit or
+            filled by the first/last value. The interpolated daily values are piecewise
+            linear, so their mean is the sum of a trapezoid for each piece (exact for the
+            days of the summer) computed from the sorted observations of all stations.
+
+            For streams, dvfi_panel() gives the DVFI index by station and year from the
+            observations of all monitoring versions in a single grouped aggregation
+            rather than merging a column for each year into the panel of each version.
+
+            The column of a year only depends on the observations of that year, so the
+            panels can be kept as artifacts in the output folder (e.g., output/streams_
+            ind_panel.parquet) along with a hash of the observations behind each column.
+            When the panel is updated (e.g., year_last is raised in script.py), only
+            the years with new or changed observations are computed and the columns of
+            the other years are reused. Delete the artifact to force a full rebuild.
+
+            Waterbody_Panel keeps a panel by water body and year (e.g., the ecological
+            status) as NumPy arrays: int32 water body IDs, int16 years, a matrix of values
+            (int8 for ecological status or float32), and a bitmask of missing values.
+            Characteristics of the water bodies (e.g., Basis and length from dfVP) are
+            aligned to the rows once and then attached by position, so the stages of
+            ecological_status() and impute_missing() that do not need pandas work on
+            views of the arrays rather than merging and copying DataFrames.
+
+Functions:  The module contains 5 functions and a class:
+            - summer_average() estimates the chlorophyll summer average by station and year.
+            - dvfi_panel() sets up the DVFI index by station and year with precedence, which
+              calls:
+                - dvfi_index()
+            - update_panel() reuses the columns of unchanged years, which calls:
+                - year_hashes()
+            - Waterbody_Panel keeps a panel by water body and year as arrays.
+
+License:    MIT Copyright (c) 2025
+Author:     Thor Donsby Noe
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def summer_average(ind, limit=41, n=4):
+    """Summer average (May 1 to September 30) of the indicator for every station and
+    year with observations on at least n days in the summer, where the daily values are
+    linearly interpolated between observations (see Usage above). Observations on the
+    same day are averaged.
+
+    ind is a Series of observations with a MultiIndex of station and date. Returns a
+    DataFrame with stations as index and a column for each year with observations."""
+    df = ind.rename("ind").reset_index()
+    df.columns = ["station", "date", "ind"]
+    df["year"] = df["date"].dt.year
+    years = np.sort(df["year"].unique())  #  a column for every year with observations
+
+    # Days since May 1 (September 30 is day 152); window of limit + 1 days around summer
+    may = pd.to_datetime(df["year"].astype(str) + "-05-01")
+    df["day"] = (df["date"] - may).dt.days
+    S1 = 152
+    df = df[(df["day"] >= -limit - 1) & (df["day"] <= S1 + limit + 1)]
+
+    # Take the mean of multiple obs for any station-date and sort by station-year-day
+    df = df.groupby(["station", "year", "day"])["ind"].mean().reset_index()
+
+    # Keep station-years with observations on at least n days during the summer
+    summer = (df["day"] >= 0) & (df["day"] <= S1)
+    enough = summer.groupby([df["station"], df["year"]]).transform("sum") >= n
+    df, summer = df[enough], summer[enough].to_numpy()
+    if df.empty:
+        return pd.DataFrame(columns=years, index=pd.Index([], name="station"))
+    g = df.groupby(["station", "year"]).ngroup().to_numpy()  #  station-year as integer
+    x, v = df["day"].to_numpy(), df["ind"].to_numpy()
+
+    # Knots of the daily values in the summer: (station-year, day, value)
+    knots = [(g[summer], x[summer], v[summer])]  #  summer observations
+
+    # Consecutive observations a and b of a station-year and the line between them
+    same = g[:-1] == g[1:]
+    ga, a, b, va, vb = (
+        g[:-1][same],
+        x[:-1][same],
+        x[1:][same],
+        v[:-1][same],
+        v[1:][same],
+    )
+    slope = (vb - va) / (b - a)
+    big = b - a - 1 > 2 * limit  #  gap with days not interpolated by the first pass
+    p, q = a + limit, b - limit  #  last days interpolated after a and before b
+    for day, z in [(p, p), (q, q)]:
+        keep = big & (day >= 0) & (day <= S1)  #  interpolated end of gap in summer
+        knots.append(
+            (ga[keep], day[keep], va[keep] + slope[keep] * (z[keep] - a[keep]))
+        )
+    for S, z in [(0, q), (S1, p)]:
+        gap = big & (p < S) & (q > S)  #  May 1 (September 30) is within the gap
+        cross = (a < S) & (b > S)
+        line = np.where(gap, z, S)  #  first (last) value in summer or the line at S
+        knots.append(
+            (ga[cross], np.full(cross.sum(), S), (va + slope * (line - a))[cross])
+        )
+
+    # First (last) observation after May 1 (before September 30) fills the edges
+    first = np.r_[True, g[1:] != g[:-1]]
+    last = np.r_[g[1:] != g[:-1], True]
+    lead, trail = first & (x > 0), last & (x < S1)
+    knots.append((g[lead], np.zeros(lead.sum(), dtype=x.dtype), v[lead]))
+    knots.append((g[trail], np.full(trail.sum(), S1), v[trail]))
+
+    # Sum over the days of the pieces between knots (trapezoids) and the end points
+    kg, kx, kv = (np.concatenate(k) for k in zip(*knots))
+    order = np.lexsort((kx, kg))
+    kg, kx, kv = kg[order], kx[order], kv[order]
+    piece = kg[:-1] == kg[1:]
+    total = np.bincount(
+        kg[:-1][piece], (np.diff(kx) * (kv[:-1] + kv[1:]) / 2)[piece], g.max() + 1
+    )
+    ends = np.r_[True, kg[1:] != kg[:-1]] | np.r_[kg[1:] != kg[:-1], True]
+    total += np.bincount(kg[ends], kv[ends] / 2, g.max() + 1)
+
+    # Summer average by station (index) and year (columns)
+    index = df[["station", "year"]].drop_duplicates()
+    mean = pd.Series(total / (S1 + 1), index=pd.MultiIndex.from_frame(index))
+    return mean.unstack("year").reindex(columns=years).rename_axis(columns=None)
+
+
+def dvfi_panel(df, path=None):
+    """DVFI index by station and year, where the median of multiple observations for a
+    station in a given year is rounded down. If the observations come from several
+    sources (e.g., monitoring versions), the median of the source with the highest
+    precedence is used for each station-year (e.g., DVFI > DVFI, MIB > Faunaklasse,
+    felt), which is the same as taking the last non-missing value of the panels of
+    each source in increasing order of precedence.
+
+    df has the station as index and columns x, y, location, year, ind, and (optionally)
+    source as the integer precedence. Returns a DataFrame with stations as index, the
+    last non-missing x, y, and location of each station, and a column for each year.
+    If path is given, the columns of years with unchanged observations are reused from
+    the panel saved at path (see update_panel)."""
+    df = df.reset_index()
+    if "source" not in df.columns:
+        df["source"] = 0  #  a single source
+
+    # Last non-null entry of each station by source, then across sources by precedence
+    long = df.groupby(["source", "station"])[["x", "y", "location"]].last()
+    long = long.groupby(level="station").last()
+
+    # Add a column for each year with observations (sorted by year)
+    if path is None:
+        dfYears = dvfi_index(df)
+    else:
+        dfYears = update_panel(df, dvfi_index, path)
+    return long.join(dfYears)
+
+
+def dvfi_index(df):
+    """Columns by year of dvfi_panel() for the observations in df (see above)."""
+    # Median by station, year, and source rounded down (one grouped aggregation)
+    ind = df.groupby(["station", "year", "source"])["ind"].median().apply(np.floor)
+
+    # Keep the source with the highest precedence for each station-year
+    ind = ind.groupby(level=["station", "year"]).last()
+    return ind.unstack("year").rename_axis(columns=None)
+
+
+def year_hashes(df):
+    """Hash of the observations (all columns, index, and order of the rows) for each
+    year in the column 'year' of df."""
+    rows = pd.util.hash_pandas_object(df, index=True).to_numpy()
+    hashes = {}
+    for t, i in df.groupby("year", sort=True).indices.items():
+        hashes[str(t)] = hashlib.sha256(rows[np.sort(i)].tobytes()).hexdigest()[:16]
+    return hashes
+
+
+def update_panel(df, build, path):
+    """Columns by year of the panel of the observations df (with a column 'year'),
+    where build(df) returns the columns by year for the observations of some years.
+
+    The columns are saved at path (Parquet) with the hash of the observations of each
+    year. The columns of years with unchanged observations are read from path, while
+    the years with new or changed observations are built, and years without
+    observations are dropped. Then the updated columns are saved at path."""
+    hashes = year_hashes(df)
+
+    # Columns of the saved panel (if any) and the hashes of their observations
+    saved, savedHashes = None, {}
+    if os.path.exists(path):
+        table = pq.read_table(path)
+        savedHashes = json.loads(table.schema.metadata[b"year_hashes"])
+        saved = table.to_pandas()  #  stations as index
+        saved.columns = saved.columns.astype(int)
+
+    # Build the columns of the years with new or changed observations
+    new = [int(t) for t, h in hashes.items() if savedHashes.get(t) != h]
+    keep = [int(t) for t, h in hashes.items() if savedHashes.get(t) == h]
+    if saved is not None and not new:
+        return saved[keep].dropna(how="all")  #  no new or changed observations
+    dfYears = build(df[df["year"].isin(new)])
+    if keep:
+        dfYears = dfYears.join(saved[keep], how="outer")
+    dfYears = dfYears.reindex(columns=sorted(new + keep)).rename_axis("station")
+    dfYears = dfYears.dropna(how="all")  #  stations without observations in the years
+
+    # Save the updated columns with the hashes (write to a temporary file first)
+    out = dfYears.copy()
+    out.columns = out.columns.astype(str)
+    table = pa.Table.from_pandas(out)
+    metadata = {**table.schema.metadata, b"year_hashes": json.dumps(hashes)}
+    pq.write_table(table.replace_schema_metadata(metadata), path + "_temp")
+    os.replace(path + "_temp", path)
+    return dfYears
+
+
+class Waterbody_Panel:
+    """Panel of a variable by water body and year with attributes attached by position"""
+
+    def __init__(self, wb, years, values, attributes=None):
+        """wb holds the water body IDs (rows), years the years (columns), and values the
+        matrix by water body and year (missing as NaN). The values are stored as int8
+        if all known values are integers from 0 to 127 (e.g., ecological status, where
+        missing values are stored as -1) and as float32 otherwise (missing as NaN).
+        attributes is a DataFrame of characteristics by water body ID (e.g., dfVP)."""
+        self.wb = np.asarray(wb, dtype=np.int32)
+        self.years = np.asarray(years, dtype=np.int16)
+        values = np.asarray(values, dtype=np.float64)
+
+        # Bitmask of missing values (a bit for each year, packed by water body)
+        missing = np.isnan(values)
+        self.bits = np.packbits(missing, axis=1)
+
+        # Compact matrix of values
+        known = values[~missing]
+        if np.all((known == np.floor(known)) & (known >= 0) & (known <= 127)):
+            self.values = np.where(missing, -1, values).astype(np.int8)
+        else:
+            self.values = values.astype(np.float32)
+
+        # Attributes by position (aligned to the rows once)
+        self.attributes = {}
+        if attributes is not None:
+            self.attach(attributes)
+
+    @classmethod
+    def from_frame(cls, df, attributes=None):
+        """Panel of the DataFrame df with water bodies as index and years as columns."""
+        return cls(df.index, df.columns.astype(int), df.to_numpy(float), attributes)
+
+    def __len__(self):
+        return len(self.wb)
+
+    def __getitem__(self, name):
+        """Attribute by position, e.g., panel["length"] (view, not a copy)."""
+        return self.attributes[name]
+
+    def attach(self, attributes):
+        """Attach the columns of the DataFrame attributes by water body ID (index) to the
+        rows of the panel (missing if the water body is not in attributes)."""
+        df = attributes.reindex(self.wb)
+        for c in df.columns:
+            self.attributes[c] = df[c].to_numpy()
+        return self
+
+    @property
+    def missing(self):
+        """Boolean matrix of missing values by water body and year."""
+        return np.unpackbits(self.bits, axis=1, count=len(self.years)).astype(bool)
+
+    def span(self, first=None, last=None):
+        """Slice of the columns for the years from first to last (all by default)."""
+        a = 0 if first is None else np.searchsorted(self.years, first)
+        b = None if last is None else np.searchsorted(self.years, last, "right")
+        return slice(a, b)
+
+    def view(self, first=None, last=None):
+        """View (not a copy) of the compact matrix of values for the years from first
+        to last, e.g., for the statistics of ecological status."""
+        return self.values[:, self.span(first, last)]
+
+    def matrix(self, first=None, last=None):
+        """Matrix of values as float64 with missing values as NaN (a copy), e.g., for
+        imputation."""
+        span = self.span(first, last)
+        return np.where(self.missing[:, span], np.nan, self.values[:, span])
+
+    def frame(self, attributes=()):
+        """DataFrame with water bodies (wb) as index, a column for each year, and the
+        given attributes as columns."""
+        df = pd.DataFrame(
+            self.matrix(),
+            index=pd.Index(self.wb.astype(np.int64), name="wb"),
+            columns=self.years.astype(int).tolist(),
+        )
+        for c in attributes:
+            df[c] = self.attributes[c]
+        return df
@@ -42,6 +42,8 @@ from cycler import cycler
 from sklearn.experimental import enable_iterative_imputer  # noqa
 from sklearn.impute import IterativeImputer
 
+import imputation_module
+
 
 class Water_Quality:
     """Class for all data processing and mapping functions"""
@@ -176,9 +178,12 @@ class Water_Quality:
                 # Change the directory back to the original working folder
                 os.chdir(self.path)
 
-    def impute_missing(self, j, dfEcoObs, dfVP, index):
+    def impute_missing(self, j, dfEcoObs, dfVP, index, method="chained"):
         # dfEcoObs, dfVP, index = df_eco_obs, df_VP, index_sorted
-        """Impute ecological status for all water bodies from the observed indicator."""
+        """Impute ecological status for all water bodies from the observed indicator.
+
+        The default method "chained" gives the same imputations as method "iterative"
+        (IterativeImputer from scikit-learn) within numerical precision, but faster."""
         try:
             # Merge observed ecological status each year with Basis Analysis for VP3
             dfEco = dfEcoObs.merge(dfVP[["Basis"]], on="wb")
@@ -302,7 +307,10 @@ class Water_Quality:
             dfEcoSelected = dfEco.merge(typ[cols], on="wb")  #  selected predictors
 
             # Multivariate imputer using BayesianRidge estimator w. increased tolerance
-            imputer = IterativeImputer(tol=1e-1, max_iter=100, random_state=0)
+            if method == "iterative":
+                imputer = IterativeImputer(tol=1e-1, max_iter=100, random_state=0)
+            else:  #  updates the sufficient statistics of each regression incrementally
+                imputer = imputation_module.Chained_Imputer(tol=1e-1, max_iter=100)
 
             # Fit imputer, transform data iteratively, and drop dummies again
             dfImp = pd.DataFrame(
@@ -52,6 +52,7 @@ year_first = 1989
 year_last = 2020
 
 # Specify the names of data files for each category of water body and shared statistics
+# (ODA exports above the row limit of Excel can be CSV files, e.g., "lakes.csv.gz")
 data = {
     "coastal": ["coastal_chlorophyll.xlsx"],
     "lakes": ["lakes_chlorophyll.xlsx"],
@@ -107,6 +108,9 @@ c = script_module.Water_Quality(
 # Dictionaries to store DataFrame, shore length, and stats for each category j
 frames_j, shores_j, stats_obs_j, stats_imp_j, stats_imp_MA_j = {}, {}, {}, {}, {}
 
+# Download the layers of the water body plan concurrently (only the relevant fields)
+c.get_layers_from_WFS()
+
 # Loop over each category j ∈ {coastal, lakes, streams}
 for j in ("coastal", "lakes", "streams"):
     # Get the feature class from the WFS service
@@ -115,6 +119,10 @@ for j in ("coastal", "lakes", "streams"):
     # df for observed biophysical indicator and waterbody characteristics respectively
     df_ind_obs, df_VP = c.observed_indicator(j)
 
+    # if j == "streams":
+    #     # Number of stations matched and water body panels for a grid of radii (5-100m)
+    #     sweep_stats, sweep_panels = c.radius_sweep(j)
+
     # Report ecological status based on observed biophysical indicator
     df_eco_obs, stats_obs_j[j], index_sorted = c.ecological_status(j, df_ind_obs, df_VP)
 
@@ -10,10 +10,18 @@ Rqmts:      ArcGIS Pro 3.2 or later must be installed on the system.
 Usage:      This module supports script.py and WaterbodiesScriptTool in gis.tbx.
             See GitHub.com/ThorNoe/GreenGDP for instructions to run or update it all.
 
-Functions:  The class in this module contains 13 functions of which some are nested:
+Functions:  The class in this module contains 19 functions of which some are nested:
             - get_data(), get_fc_from_WFS(), map_book(), and values_by_catchment_area() are standalone functions.
+            - get_layers_from_WFS() downloads the layers concurrently without ArcPy.
             - observed_indicator() calls:
-                - longitudinal()
+                - station_panel(), which calls:
+                    - observations()
+                    - longitudinal(), which calls:
+                        - observations()
+                - linkage_table()
+                - waterbody_geometries(), which calls:
+                    - get_layers_from_WFS() (unless the layer is downloaded already)
+            - radius_sweep() calls station_panel(), linkage_table(), and waterbody_geometries().
             - impute_missing() calls:
                 - ecological_status(), which calls:
                     - indicator_to_status()
@@ -38,10 +46,18 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 from cycler import cycler
+from matplotlib.colors import ListedColormap
 from scipy import interpolate
 from sklearn.experimental import enable_iterative_imputer  # noqa
 from sklearn.impute import IterativeImputer
 
+import imputation_module
+import match_module
+import panel_module
+import status_module
+import store_module
+import wfs_module
+
 
 class Water_Quality:
     """Class for all data processing and mapping functions"""
@@ -70,6 +86,7 @@ class Water_Quality:
         self.keep_gdb = keepGeodatabase
         self.path = os.getcwd()
         self.arcPath = self.path + "\\gis.gdb"
+        self.layers = {}  #  layers downloaded by get_layers_from_WFS()
 
         # Color-blind-friendly color scheme by Paul Tol: https://personal.sron.nl/~pault
         colors = {
@@ -228,225 +245,130 @@ class Water_Quality:
             arcpy.AddError(arcmsg)  # return ArcPy error message in ArcGIS
             sys.exit(1)
 
-    def observed_indicator(self, j, radius=15):
-        """Set up a longitudinal DataFrame for all water bodies of category j by year t.
-
-        Assign monitoring stations to water bodies in water body plan via linkage table.
-
-        For monitoring stations not included in the linkage table: Assign a station to a waterbody if the station's coordinates are located within said waterbody. For streams, if the station is within a radius of 15 meters of a stream where the name of the stream matches the location name attached to the monitoring station).
+    def get_layers_from_WFS(self, keys=None, n_jobs=4):
+        """Download the layers of the WFS service for the given keys of the feature classes (default: all) with only the relevant fields and geometries. The layers are requested page by page and concurrently, and the responses are cached in data/wfs (see wfs_module.py).
 
-        Finally, construct the longitudinal DataFrame of observed biophysical indicator by year for all water bodies in the current water body plan. Separately, save the water body ID, typology, district ID, and shore length of each water body in VP3 using the feature classes collected via the get_fc_from_WFS() function.
+        The layers are kept in the store as GeoParquet files (see store_module.py), which load in milliseconds, so a layer is only downloaded if it is not in the store or if the feature classes are to be replaced. Returns a dictionary of DataFrames, which are kept for later use.
         """
         try:
-            if j == "streams":
-                # Create longitudinal df for stations in streams by monitoring version
-                kwargs = dict(
-                    f=self.data[j][1],
-                    d="Dato",
-                    x="Xutm_Euref89_Zone32",
-                    y="Yutm_Euref89_Zone32",
-                    valueCol="Indeks",
-                    parameterCol="Indekstype",
-                )
-                DVFI_F = self.longitudinal(j, parameter="Faunaklasse, felt", **kwargs)
-                DVFI_M = self.longitudinal(j, parameter="DVFI, MIB", **kwargs)
-                DVFI = self.longitudinal(j, parameter="DVFI", **kwargs)
-
-                # Observations after 2020 (publiced after ODA database update Jan 2024)
-                DVFI2 = self.longitudinal(
-                    j,
-                    f=self.data[j][0],
-                    d="Dato",
-                    x="X-UTM",
-                    y="Y-UTM",
-                    valueCol="Indeks",
-                )
-
-                # Group by station; keep last non-missing entry each year, DVFI>MIB>felt
-                long = (
-                    pd.concat([DVFI_F, DVFI_M, DVFI, DVFI2]).groupby("station").last()
-                )
-
-            else:  #  lakes and coastal waters
-                # Create longitudinal df for stations
-                long = self.longitudinal(
-                    j,
-                    f=self.data[j][0],
-                    d="Startdato",
-                    x="X_UTM32",
-                    y="Y_UTM32",
-                    valueCol="Resultat",
+            if keys is None:
+                keys = list(self.wfs_fc.keys())
+            replace = self.wfs_replace in ("true", 1, True)
+
+            # Read the layers from the store (unless they are to be replaced)
+            for k in keys:
+                if not replace and k not in self.layers:
+                    df = store_module.read_geometries(self.wfs_fc[k])
+                    if df is not None:
+                        self.layers[k] = df
+
+            # Download the other layers concurrently and keep them in the store
+            layers = {
+                k: (self.wfs_fc[k], self.wfs_fields[k])
+                for k in keys
+                if k not in self.layers or replace
+            }
+            if layers:
+                downloads = wfs_module.get_layers(
+                    self.wfs_service, layers, n_jobs=n_jobs
                 )
-                if j == "lakes":
-                    # Obtain the few missing coordinates
-                    stations = pd.read_csv("linkage\\" + self.linkage[j][1]).astype(int)
-                    stations.columns = ["station", "x", "y"]
-                    stations.set_index("station", inplace=True)
-                    long[["x", "y"]] = long[["x", "y"]].combine_first(stations)
-
-            # Read the linkage table
-            dfLinkage = pd.read_csv("linkage\\" + self.linkage[j][0])
-
-            # Convert station ID to integers
-            dfLinkage = dfLinkage.copy()  #  to avoid SettingWithCopyWarning
-            dfLinkage.loc[:, "station"] = (
-                dfLinkage["station_id"].str.slice(7).astype(int)
-            )
-
-            # Merge longitudinal DataFrame with linkage table for water bodies in VP3
-            df = long.merge(dfLinkage[["station", "ov_id"]], how="left", on="station")
-
-            # Stations covered by the linkage tabel for the third water body plan VP3
-            link = df.dropna(subset=["ov_id"])
-
-            # Convert water body ID (wb) to integers
-            link = link.copy()  #  to avoid SettingWithCopyWarning
-            if j == "lakes":
-                link.loc[:, "wb"] = link["ov_id"].str.slice(6).astype(int)
-            else:
-                link.loc[:, "wb"] = link["ov_id"].str.slice(7).astype(int)
-
-            # Stations not covered by the linkage table for VP3
-            noLink = df[df["ov_id"].isna()].drop(columns=["ov_id"])
-
-            # Create a spatial reference object with same geographical coordinate system
-            spatialRef = arcpy.SpatialReference("ETRS 1989 UTM Zone 32N")
-
-            # Specify name of feature class for stations (points)
-            fcStations = j + "_stations"
+                for k, df in downloads.items():
+                    store_module.write_geometries(df, self.wfs_fc[k])
+                self.layers.update(downloads)
+            return {k: self.layers[k] for k in keys}
 
-            # Create new feature class shapefile (will overwrite if it already exists)
-            arcpy.CreateFeatureclass_management(
-                self.arcPath, fcStations, "POINT", spatial_reference=spatialRef
+        except:
+            # Report severe error messages
+            tb = sys.exc_info()[2]  # get traceback object for Python errors
+            tbinfo = traceback.format_tb(tb)[0]
+            msg = "Could not download layers from WFS:\nTraceback info:\n{0}Error Info:\n{1}".format(
+                tbinfo, str(sys.exc_info()[1])
             )
+            print(msg)  # print error message in Python
+            arcpy.AddError(msg)  # return error message in ArcGIS
+            sys.exit(1)
 
-            # Create field for 'station' and list fields
-            arcpy.AddField_management(fcStations, "station", "INTEGER")
-            fieldsStations = ["SHAPE@XY", "station"]
-            if j == "streams":
-                # Create field for 'location' and append to list of fields
-                arcpy.AddField_management(fcStations, "location", "TEXT")
-                fieldsStations.append("location")
-
-            # Create cursor to insert stations that were not in the linkage table
-            try:
-                with arcpy.da.InsertCursor(fcStations, fieldsStations) as cursor:
-                    # Loop over each station-ID in df:
-                    for index, row in noLink.iterrows():
-                        try:
-                            # Use cursor to insert new row in feature class
-                            if j == "streams":
-                                cursor.insertRow(
-                                    [
-                                        (row["x"], row["y"]),
-                                        row["station"],
-                                        row["location"],
-                                    ]
-                                )
-                            else:
-                                cursor.insertRow([(row["x"], row["y"]), row["station"]])
-
-                        except:
-                            # Report other severe error messages from Python or ArcPy
-                            tb = sys.exc_info()[
-                                2
-                            ]  # get traceback object for Python errors
-                            tbinfo = traceback.format_tb(tb)[0]
-                            print(
-                                "Python errors while inserting station {0} in {1}:\nTraceback info:{2}\nError Info:\n{3}\n".format(
-                                    str(row["station"]),
-                                    fcStations,
-                                    tbinfo,
-                                    str(sys.exc_info()[1]),
-                                )
-                            )
-                            print(
-                                "ArcPy errors while inserting station {0} in {1}:\n{2}".format(
-                                    str(row["station"]),
-                                    fcStations,
-                                    tbinfo,
-                                )
-                            )
-                            sys.exit(1)
+    def observed_indicator(self, j, radius=15):
+        """Set up a longitudinal DataFrame for all water bodies of category j by year t.
 
-                        finally:
-                            # Clean up for next iteration
-                            del index, row
+        Assign monitoring stations to water bodies in water body plan via linkage table.
 
-            finally:
-                del cursor
+        For monitoring stations not included in the linkage table: Assign a station to a waterbody if the station's coordinates are located within said waterbody. For streams, if the station is within a radius of 15 meters of a stream where the name of the stream matches the location name attached to the monitoring station). The stations are matched using a spatial index over the water bodies (see match_module.py).
 
-            # Specify name of feature class for streams in VP3 (polylines)
+        Finally, construct the longitudinal DataFrame of observed biophysical indicator by year for all water bodies in the current water body plan. Separately, save the water body ID, typology, district ID, and shore length of each water body in VP3 using the feature classes collected via the get_fc_from_WFS() function.
+        """
+        try:
+            # Longitudinal df of the observed indicator for all stations
+            long = self.station_panel(j)
+
+            # Registry of the stations assigned to water bodies for the current water
+            # body plan (a version for each linkage table, layer of water bodies, file
+            # of coordinates, and radius), so only stations that were not seen before
+            # are matched (see match_module.py), while all stations are matched again
+            # (including those without a match before) if any of these changes
+            fileLinkage = "linkage\\" + self.linkage[j][0]
+            pathRegistry = "output\\" + j + "_stations_" + self.wfs_fc[j] + ".csv"
+            dfWB = self.waterbody_geometries(j)  #  water bodies with geometries
+            hashes = [
+                store_module.file_hash(fileLinkage),
+                store_module.geometries_hash(dfWB),
+            ]
+            if j == "lakes":  #  the few missing coordinates (see station_panel)
+                hashes.append(store_module.file_hash("linkage\\" + self.linkage[j][1]))
+            version = "_".join(hashes) + "_{0}m".format(radius)
+            registry = match_module.read_registry(pathRegistry, version)
+            nRegistry = len(registry)
+
+            if registry.empty:
+                # Stations covered by the linkage tabel for the third water body plan VP3
+                registry = self.linkage_table(j).assign(method="linkage")
+
+            # Stations not in the registry, i.e., neither in the linkage table for VP3
+            # nor matched before (e.g., new monitoring stations)
+            df = long.reset_index()  #  station as column
+            noLink = df[~df["station"].isin(registry["station"])]
+
+            # Specify name of feature class for water bodies in VP3
             fc = j
 
-            # Specify name of joined feature class (polylines)
-            fcJoined = fcStations + "_joined"
-
-            # Spatial Join unmatched stations with streams within given radius
-            arcpy.SpatialJoin_analysis(
-                target_features=fc,
-                join_features=fcStations,
-                out_feature_class=fcJoined,  #  will overwrite if it already exists
-                join_operation="JOIN_ONE_TO_MANY",
-                join_type="KEEP_COMMON",
-                match_option="CLOSEST",  #  if more than one stream is within radius
-                search_radius=radius,  #  match to stream withing radius of station
-                distance_field_name="Distance",
-            )
-
-            # Specify fields of interest of fcJoined
-            if j == "streams":
-                fieldsJ = ["station", "ov_id", "ov_navn", "location", "Distance"]
-            else:  #  lakes and coastal waters
-                fieldsJ = ["station", "ov_id"]
-
-            # Create DataFrame from fcJoined and sort by distance (ascending)
-            stations = [row for row in arcpy.da.SearchCursor(fcJoined, fieldsJ)]
-            join = pd.DataFrame(stations, columns=fieldsJ)
-
-            # Convert water body ID (wb) to integers
-            join = join.copy()  #  to avoid SettingWithCopyWarning
-            if j == "lakes":
-                join.loc[:, "wb"] = join["ov_id"].str.slice(6).astype(int)
-            else:
-                join.loc[:, "wb"] = join["ov_id"].str.slice(7).astype(int)
-
-            if j == "streams":
-                # Capitalize water body names
-                join["ov_navn"] = join["ov_navn"].str.upper()
-
-                # Rename unnamed water bodies to distinguish from named water bodies
-                join["location"].mask(
-                    join["location"] == "[IKKE NAVNGIVET]", "UDEN NAVN", inplace=True
-                )
+            if len(noLink) > 0:
+                # Spatial join of unmatched stations with the closest water body within
+                # the radius for all stations at once using a spatial index
+                fieldsStations = ["station", "x", "y"]
+                if j == "streams":
+                    fieldsStations.append("location")  #  for matching names
+                join = match_module.spatial_join(dfWB, noLink[fieldsStations], radius)
 
-                # a Indicate that station and stream has the same water body name
-                join["match"] = np.select([join["location"] == join["ov_navn"]], [True])
+                if j == "streams":
+                    # Unique stations with their closest water body with matching name
+                    join = match_module.matching_names(join)
 
-                # Subset to unique stations with their closest matching water body
-                jClosest = (
-                    join[join["match"] == True]
-                    .sort_values("Distance")
-                    .groupby("station", as_index=False)
-                    .first()
+                # Register the matched stations and the stations without a match
+                matched = join[["station", "wb", "Distance"]].assign(method="spatial")
+                unmatched = noLink[["station"]][
+                    ~noLink["station"].isin(join["station"])
+                ]
+                registry = pd.concat(
+                    [registry, matched, unmatched.assign(method="none")],
+                    ignore_index=True,
                 )
 
-                # Inner merge of noLink stations and jClosest water body with matching name
-                noLinkClosest = noLink.merge(jClosest[["station", "wb"]], on="station")
-
-                # df containing all stations that have been matched to a water body
-                allMatches = pd.concat([link, noLinkClosest]).drop(
-                    columns=["station", "location", "x", "y", "ov_id"]
-                )
+            if len(registry) > nRegistry:
+                # Save the registry for the next run
+                match_module.write_registry(registry, pathRegistry, version)
 
-            else:  #  for lakes and coastal waters
-                # df containing all stations that have been matched to a water body
-                allMatches = pd.concat([link, join]).drop(
-                    columns=["station", "x", "y", "ov_id"]
-                )
+            # Stations covered by the linkage table and stations matched spatially
+            link = registry[registry["method"] == "linkage"]
+            spatial = registry[
+                (registry["method"] == "spatial")
+                & registry["station"].isin(df["station"])
+            ]
 
             # Group multiple stations in a water body: Take the median and round down
-            waterbodies = allMatches.groupby("wb").median().apply(np.floor)
+            if j == "streams":
+                waterbodies = match_module.waterbodies(df, pd.concat([link, spatial]))
+            else:  #  stations inside lakes and coastal waters add no observations
+                waterbodies = match_module.waterbodies(df, link)
 
             # Specify the biophysical indicator for the current category
             if j == "streams":
@@ -538,19 +460,21 @@ class Water_Quality:
 
             # Report stations matched by linkage table and distance+name respectively
             if j == "streams":
-                msg = "{0}:\n{1} out of {2} stations were linked to a water body by the official linkage table. Besides, {3} stations were located within {4} meters of a water body carrying the name of the station's location.".format(
+                msg = "{0}:\n{1} out of {2} stations were linked to a water body by the official linkage table. Besides, {3} stations were located within {4} meters of a water body carrying the name of the station's location ({5} stations were matched in this run).".format(
                     str(j),
-                    len(link),
+                    link["station"].isin(df["station"]).sum(),
                     len(df),
-                    len(jClosest),
+                    len(spatial),
                     str(radius),
+                    len(noLink),
                 )
             else:
-                msg = "{0}:\n{1} out of {2} stations were linked to a water body by the official linkage table for VP3. Besides, {3} stations were located inside the polygon shape of a water body present in VP3.".format(
+                msg = "{0}:\n{1} out of {2} stations were linked to a water body by the official linkage table for VP3. Besides, {3} stations were located inside the polygon shape of a water body present in VP3 ({4} stations were matched in this run).".format(
                     str(j),
-                    len(link),
+                    link["station"].isin(df["station"]).sum(),
                     len(df),
-                    len(join),
+                    len(spatial),
+                    len(noLink),
                 )
             print(msg)  # print number of stations in Python
             arcpy.AddMessage(msg)  # return number of stations in ArcGIS
@@ -575,102 +499,216 @@ class Water_Quality:
             arcpy.AddError(arcmsg)  # return ArcPy error message in ArcGIS
             sys.exit(1)
 
-        finally:  # Clean up
-            for fc in [fcStations, fcJoined]:  # Delete feature classes
-                if arcpy.Exists(fc):
-                    arcpy.Delete_management(fc)
-            del fcStations, fcJoined
+    def station_panel(self, j):
+        """Set up a longitudinal DataFrame of the observed biophysical indicator for all stations in category j by year t (see longitudinal)."""
+        if j == "streams":
+            # Observations in streams by monitoring version in increasing order of
+            # precedence, which are read from the historical export at once
+            versions = ["Faunaklasse, felt", "DVFI, MIB", "DVFI"]
+            df = self.observations(
+                j,
+                f=self.data[j][1],
+                d="Dato",
+                x="Xutm_Euref89_Zone32",
+                y="Yutm_Euref89_Zone32",
+                valueCol="Indeks",
+                parameterCol="Indekstype",
+                parameter=versions,
+            )
+
+            # Observations after 2020 (publiced after ODA database update Jan 2024)
+            df2 = self.observations(
+                j,
+                f=self.data[j][0],
+                d="Dato",
+                x="X-UTM",
+                y="Y-UTM",
+                valueCol="Indeks",
+            )
+            df2["source"] = len(versions)  #  highest precedence
+
+            # Create longitudinal df for stations in streams in a single pass: for
+            # each station and year, keep the median of the monitoring version with
+            # the highest precedence, DVFI>MIB>felt (see panel_module.py)
+            # Keep the panel in the output folder and only compute the years with
+            # new or changed observations when it is updated (e.g., a new year)
+            path = "output\\" + j + "_ind_panel.parquet"
+            long = panel_module.dvfi_panel(pd.concat([df, df2]), path)
+
+        else:  #  lakes and coastal waters
+            # Create longitudinal df for stations
+            long = self.longitudinal(
+                j,
+                f=self.data[j][0],
+                d="Startdato",
+                x="X_UTM32",
+                y="Y_UTM32",
+                valueCol="Resultat",
+                path="output\\" + j + "_ind_panel.parquet",  #  keep the panel
+            )
+            if j == "lakes":
+                # Obtain the few missing coordinates
+                stations = pd.read_csv("linkage\\" + self.linkage[j][1]).astype(int)
+                stations.columns = ["station", "x", "y"]
+                stations.set_index("station", inplace=True)
+                long[["x", "y"]] = long[["x", "y"]].combine_first(stations)
+
+        return long
+
+    def linkage_table(self, j):
+        """Read the linkage table of stations and water bodies in the current water body plan with station and water body ID (wb) as integers."""
+        dfLinkage = pd.read_csv("linkage\\" + self.linkage[j][0]).dropna(
+            subset=["ov_id"]
+        )
+        dfLinkage["station"] = match_module.id_number(dfLinkage["station_id"])
+        dfLinkage["wb"] = match_module.id_number(dfLinkage["ov_id"])
+        return dfLinkage[["station", "wb"]]
+
+    def waterbody_geometries(self, j):
+        """Water bodies of category j in the current water body plan with their geometries (shapely) in the column 'geometry' as downloaded by get_layers_from_WFS()."""
+        if j not in self.layers:
+            self.get_layers_from_WFS([j])
+        fieldsWB = ["ov_id", "ov_navn"] if j == "streams" else ["ov_id"]
+        dfWB = self.layers[j][fieldsWB + ["geometry"]].dropna(subset=["geometry"])
+        dfWB["wb"] = match_module.id_number(dfWB["ov_id"])
+        return dfWB
+
+    def radius_sweep(self, j, radii=range(5, 101, 5)):
+        """Match the stations in category j that are not in the linkage table to water bodies for each radius in radii (in meters) using one query of the spatial index with the largest radius.
+
+        Save the number of stations within the radius of a water body, the number and share of those matched (the name of the stream matches the location name of the station for streams), and the number of water bodies with observations for each radius to output/j_radius_sweep.csv. Also, save the longitudinal DataFrame of the observed indicator by water body for each radius to output/j_ind_obs_sweep.csv.
+        """
+        try:
+            # Longitudinal df of the observed indicator for all stations
+            df = self.station_panel(j).reset_index()  #  station as column
+
+            # Stations covered by the linkage table for VP3 and the other stations
+            link = self.linkage_table(j)
+            noLink = df[~df["station"].isin(link["station"])]
+
+            # Spatial joins for all radii from one query of the spatial index
+            fieldsStations = ["station", "x", "y"]
+            if j == "streams":
+                fieldsStations.append("location")  #  for matching names
+            joins = match_module.spatial_joins(
+                self.waterbody_geometries(j), noLink[fieldsStations], radii
+            )
+
+            stats, panels = {}, {}
+            for r, join in joins.items():
+                # Stations within the radius of a water body (closest for the water body)
+                joined = join["station"].nunique()
+                if j == "streams":
+                    # Unique stations with their closest water body with matching name
+                    join = match_module.matching_names(join)
+                    assigned = pd.concat([link, join[["station", "wb"]]])
+                else:  #  stations inside lakes and coastal waters add no observations
+                    assigned = link
+
+                # Group multiple stations in a water body: Take the median, round down
+                panels[r] = match_module.waterbodies(df, assigned)
+                stats[r] = {
+                    "joined": joined,
+                    "matched": join["station"].nunique(),
+                    "match rate": join["station"].nunique() / max(joined, 1),
+                    "water bodies": panels[r].notna().any(axis=1).sum(),
+                }
+
+            # Save the statistics and the water body panels by radius to CSV
+            stats = pd.DataFrame.from_dict(stats, orient="index").rename_axis("radius")
+            stats.to_csv("output\\" + j + "_radius_sweep.csv")
+            panels = pd.concat(panels, names=["radius"])
+            panels.to_csv("output\\" + j + "_ind_obs_sweep.csv")
 
-    def longitudinal(self, j, f, d, x, y, valueCol, parameterCol=0, parameter=0):
+            return stats, panels
+
+        except:
+            # Report severe error messages
+            tb = sys.exc_info()[2]  # get traceback object for Python errors
+            tbinfo = traceback.format_tb(tb)[0]
+            msg = "Could not sweep the radius for {0}:\nTraceback info:\n{1}Error Info:\n{2}".format(
+                j, tbinfo, str(sys.exc_info()[1])
+            )
+            print(msg)  # print error message in Python
+            arcpy.AddError(msg)  # return error message in ArcGIS
+            sys.exit(1)
+
+    def observations(self, j, f, d, x, y, valueCol, parameterCol=0, parameter=0):
+        """Read the observations of the biophysical indicator for all stations in category j and return them with the station as index.
+
+        If parameter is a list (e.g., the monitoring versions of the DVFI index for streams), the observations of every parameter in the list are read at once and the column 'source' gives the position of the parameter of each observation in the list (i.e., the order of precedence).
+        """
+        # Subset the data to only contain the relevant parameter(s) (if any)
+        several = isinstance(parameter, list)
+        filters = None
+        if parameterCol != 0:
+            filters = [(parameterCol, "in" if several else "==", parameter)]
+        # Read the data for biophysical indicator (source: https://ODAforalle.au.dk)
+        # from the columnar store, which converts each export once (store_module.py)
+        df = store_module.read(f, d, filters=filters)  #  incl. 'year' column
+        # Rename the station ID column and make it the index of df
+        df = df.set_index("ObservationsStedNr").rename_axis("station")
+        # Drop missing values and sort by year (keep the order of the export otherwise)
+        df = df.dropna(subset=valueCol).sort_values("year", kind="stable")
+        # Position of the parameter of each observation in the list of parameters
+        source = []
+        if several:
+            df["source"] = df[parameterCol].map({p: i for i, p in enumerate(parameter)})
+            source = ["source"]
+        # Column names for the final longitudinal DataFrame besides the indicator
+        cols = ["x", "y"]
+        if j == "streams":
+            cols.append("location")  #  add location name for final DataFrame
+            df = df[[x, y, "Lokalitetsnavn", "year", valueCol] + source]  #  subset
+            df.columns = cols + ["year", "ind"] + source  #  shorten column names
+            df["location"] = df["location"].str.upper()  # capitalize location names
+            df = df[df["ind"] != "U"]  #  drop obs with unknown indicator value "U"
+            df["ind"] = df["ind"].astype(int)  #  convert indicator to integer
+        else:  # Lakes and coastal waters
+            # Convert date column to datetime format
+            df[d] = pd.to_datetime(df[d].astype(str), format="%Y%m%d")  #  convert
+            df = df[[x, y, d, "year", valueCol] + source]  #  subset to relevant columns
+            df.columns = cols + ["date", "year", "ind"] + source  #  shorten names
+            df.set_index("date", append=True, inplace=True)  #  add 'date' to index
+
+        # Replace 0-values with missing in 'x' and 'y' columns
+        df[["x", "y"]] = df[["x", "y"]].replace(0, np.nan)
+
+        return df
+
+    def longitudinal(
+        self, j, f, d, x, y, valueCol, parameterCol=0, parameter=0, path=None
+    ):
         """Set up a longitudinal DataFrame for all stations in category j by year t.
 
         Streams: For a given year, find the DVFI index value of bottom fauna for a station with multiple observations by taking the median and rounding down.
 
         Lakes and coastal waters: For a given year, estimate the chlorophyll summer average for every station monitored at least four times during May-September by linear interpolating of daily data from May 1 to September 30 (or extrapolate by inserting the first/last observation from May/September if there exist no observations outside of said period that are no more than 6 weeks away from the first/last observation in May/September).
+
+        If path is given, the panel is kept as an artifact at path and only the years with new or changed observations are computed when it is updated (see panel_module.py).
         """
         try:
-            # Read the data for biophysical indicator (source: https://ODAforalle.au.dk)
-            df = pd.read_excel("data\\" + f)
-            # Rename the station ID column and make it the index of df
-            df = df.set_index("ObservationsStedNr").rename_axis("station")
-            # Create 'Year' column from the date column
-            df = df.copy()  #  to avoid SettingWithCopyWarning
-            df.loc[:, "year"] = df[d].astype(str).str.slice(0, 4).astype(int)
-            if parameterCol != 0:
-                # Subset the data to only contain the relevant parameter
-                df = df[df[parameterCol] == parameter]
-            # Drop missing values and sort by year
-            df = df.dropna(subset=valueCol).sort_values("year")
-            # Column names for the final longitudinal DataFrame besides the indicator
-            cols = ["x", "y"]
+            # Observations of the biophysical indicator with the station as index
+            df = self.observations(j, f, d, x, y, valueCol, parameterCol, parameter)
+
             if j == "streams":
-                cols.append("location")  #  add location name for final DataFrame
-                df = df[[x, y, "Lokalitetsnavn", "year", valueCol]]  #  subset columns
-                df.columns = cols + ["year", "ind"]  #  shorten column names
-                df["location"] = df["location"].str.upper()  # capitalize location names
-                df = df[df["ind"] != "U"]  #  drop obs with unknown indicator value "U"
-                df["ind"] = df["ind"].astype(int)  #  convert indicator to integer
-            else:  # Lakes and coastal waters
-                # Convert date column to datetime format
-                df[d] = pd.to_datetime(df[d].astype(str), format="%Y%m%d")  #  convert
-                df = df[[x, y, d, "year", valueCol]]  #  subset to relevant columns
-                df.columns = cols + ["date", "year", "ind"]  #  shorten column names
-                df.set_index("date", append=True, inplace=True)  #  add 'date' to index
-
-            # Replace 0-values with missing in 'x' and 'y' columns
-            df[["x", "y"]] = df[["x", "y"]].replace(0, np.nan)
-
-            # Set up a longitudinal df with every station and its last non-null entry
-            long = df[cols].groupby(level="station").last()
-
-            # For each year t, add a column with observations for the indicator
-            for t in df["year"].unique():
-                # Subset to year t
-                dft = df[df["year"] == t]
-                # Subset to station and indicator columns only
-                dft = dft[["ind"]]
-                if j == "streams":
-                    # Group multiple obs for a station: Take the median and round down
-                    dfYear = dft.groupby("station").median().apply(np.floor).astype(int)
-                    # Rename the indicator column to year t
-                    dfYear.columns = [t]
-                else:
-                    # Generate date range 6 weeks before and after May 1 and September 30
-                    dates = pd.date_range(str(t) + "-03-20", str(t) + "-11-11")
-                    summer = pd.date_range(str(t) + "-05-01", str(t) + "-09-30")
-                    # Subset to dates in the date range
-                    dft = dft.loc[
-                        (dft.index.get_level_values("date") >= dates.min())
-                        & (dft.index.get_level_values("date") <= dates.max())
-                    ]
-                    # Take the mean of multiple obs for any station-date combination
-                    dft = dft.groupby(level=["station", "date"]).mean()
-                    # Pivot dft with dates as index and stations as columns
-                    dft = dft.reset_index().pivot(
-                        index="date", columns="station", values="ind"
-                    )
-                    # Subset dft to rows that are within the summer date range
-                    dftSummer = dft.loc[dft.index.isin(summer), :]
-                    # Drop columns (stations) with less than 4 values
-                    dftSummer = dftSummer.dropna(axis=1, thresh=4)
-                    # Create empty DataFrame with dates as index and stations as columns
-                    dfd = pd.DataFrame(index=dates, columns=dftSummer.columns)
-                    # Update the empty dfd with the chlorophyll observations in dft
-                    dfd.update(dft)
-                    # Convert to numeric, errors='coerce' will set non-numeric values to NaN
-                    dfd = dfd.apply(pd.to_numeric, errors="coerce")
-                    # Linear Interpolation of missing values with consecutive gap < 6 weeks
-                    dfd = dfd.interpolate(limit=41, limit_direction="both")
-                    # Linear Interpolation for May-September without limit
-                    dfd = dfd.loc[dfd.index.isin(summer), :].interpolate(
-                        limit_direction="both"
+                # Median by station and year rounded down (all at once) with the last
+                # non-null coordinates and location name of every station (panel_module)
+                long = panel_module.dvfi_panel(df, path)
+            else:
+                # Set up a longitudinal df with every station and its last non-null entry
+                long = df[["x", "y"]].groupby(level="station").last()
+
+                # Summer average of chlorophyll for every station and year (all at once)
+                # using linear interpolation with gaps < 6 weeks (see panel_module.py)
+                if path is None:
+                    dfYears = panel_module.summer_average(df["ind"])
+                else:  #  only compute years with new or changed observations
+                    dfYears = panel_module.update_panel(
+                        df, lambda df: panel_module.summer_average(df["ind"]), path
                     )
-                    # Drop any column that might somehow still contain missing values
-                    dfd = dfd.dropna(axis=1)
-                    # Take the summer average of chlorophyll for each station in year t
-                    dfYear = dfd.groupby(dfd.index.year).mean().T
                 # Merge into longitudinal df
-                long = long.merge(dfYear, how="left", on="station")
+                long = long.merge(dfYears, how="left", on="station")
 
             return long
 
@@ -685,11 +723,25 @@ class Water_Quality:
             arcpy.AddError(msg)  # return error message in ArcGIS
             sys.exit(1)
 
-    def impute_missing(self, j, dfEcoObs, dfVP, index):
-        """Impute ecological status for all water bodies from the observed indicator."""
+    def impute_missing(
+        self, j, dfEcoObs, dfVP, index, method="chained", warm=False, tolerance=0.05
+    ):
+        """Impute ecological status for all water bodies from the observed indicator.
+
+        The default method "chained" gives the same imputations as method "iterative"
+        (IterativeImputer from scikit-learn) within numerical precision, but faster.
+        Method "als" or "soft" imputes by low-rank matrix completion for very large
+        panels (see Low_Rank_Imputer in imputation_module.py).
+
+        The fit is saved as output/j_eco_imp_method.npz. Opt in with warm=True to start
+        the fit from the saved imputations (e.g., when a year is added) unless the method
+        is "iterative". As the rounds stop early, a warm fit depends on its start, so a
+        warm fit and a fit from scratch are compared on a sample of the water bodies
+        first (see drift in imputation_module.py). The data is fitted from scratch (the
+        default) if they differ by more than the tolerance on average."""
         try:
-            # Merge observed ecological status each year with basis analysis for VP3
-            dfEco = dfEcoObs.merge(dfVP[["Basis"]], on="wb")
+            # Panel of observed ecological status with basis analysis for VP3 attached
+            panel = panel_module.Waterbody_Panel.from_frame(dfEcoObs, dfVP[["Basis"]])
 
             if j == "streams":
                 # Create dummies for typology
@@ -806,18 +858,62 @@ class Water_Quality:
                     "Sediment",
                 ]
 
-            # Merge DataFrame for observed values with DataFrame for dummies
-            dfEcoSelected = dfEco.merge(typ[cols], on="wb")  #  selected predictors
+            # Matrix of observed values, basis analysis, and dummies (by position)
+            X = np.column_stack(
+                [
+                    panel.matrix(),
+                    panel["Basis"].astype(float),
+                    typ[cols].reindex(panel.wb).to_numpy(float),  #  selected predictors
+                ]
+            )
 
             # Multivariate imputer using BayesianRidge estimator w. increased tolerance
-            imputer = IterativeImputer(tol=1e-1, max_iter=100, random_state=0)
+            if method == "iterative":
+                imputer = IterativeImputer(tol=1e-1, max_iter=100, random_state=0)
+            elif method in ("als", "soft"):  #  low-rank matrix completion w. dummies
+                imputer = imputation_module.Low_Rank_Imputer(method)
+            else:  #  updates the sufficient statistics of each regression incrementally
+                imputer = imputation_module.Chained_Imputer(tol=1e-1, max_iter=100)
+
+            # Warm start from the fit saved by the latest run (if any)
+            columns = list(dfEcoObs.columns) + ["Basis"] + cols
+            path = "output\\" + j + "_eco_imp_" + method + ".npz"
+            init = None
+            if warm and method != "iterative":
+                init = imputation_module.warm_start(path, panel.wb, columns)
+
+            # Refit from scratch if a warm start shifts the imputations beyond tolerance
+            if init is not None:
+                shift = imputation_module.drift(imputer, X, init)
+                if shift > tolerance:
+                    msg = "{0}: A warm start shifts the imputations of a sample by {1:.3f} on average compared to a fit from scratch (tolerance: {2}), so the imputer is refitted from scratch.".format(
+                        j, shift, tolerance
+                    )
+                    print(msg)  # print message in Python
+                    arcpy.AddMessage(msg)  # return message in ArcGIS
+                    init = None
+
+            # Fit imputer and transform data iteratively
+            if init is None:
+                Xt = imputer.fit_transform(X)
+            else:
+                Xt = imputer.fit_transform(X, init)
+            if Xt.shape[1] != X.shape[1]:
+                # Columns without observations are dropped, which would shift the years
+                raise ValueError(
+                    "The imputer dropped {0} of {1} columns without observations, "
+                    "e.g., years".format(X.shape[1] - Xt.shape[1], X.shape[1])
+                )
 
-            # Fit imputer, transform data iteratively, and limit to years of interest
+            # Save the fit for the next run
+            imputation_module.save_fit(path, panel.wb, columns, Xt)
+
+            # Limit imputed data to years of interest
             dfImp = pd.DataFrame(
-                imputer.fit_transform(np.array(dfEcoSelected)),
-                index=dfEcoSelected.index,
-                columns=dfEcoSelected.columns,
-            )[dfEcoObs.columns]
+                Xt[:, : len(panel.years)],
+                index=dfEcoObs.index,
+                columns=dfEcoObs.columns,
+            )
 
             # Calculate a 5-year moving average (MA) for each water body to reduce noise
             dfImpMA = dfImp.T.rolling(window=5, min_periods=3, center=True).mean().T
@@ -861,36 +957,36 @@ class Water_Quality:
             # Save CSV of data on mean ecological status by water body and year
             dfEcoObs.to_csv("output\\" + j + "_eco_" + suffix + ".csv")
 
-            # Merge observed ecological status each year with basis analysis for VP3
-            dfEco = dfEcoObs.merge(dfVP[["Basis"]], on="wb")
-
             if suffix != "obs":
-                # Prepare for statistics and missing values graph
-                for t in dfEco.columns:
-                    # Convert imp status to categorical scale w. equidistant thresholds
-                    conditions = [
-                        dfEco[t] < 0.5,  # Bad
-                        (dfEco[t] >= 0.5) & (dfEco[t] < 1.5),  #  Poor
-                        (dfEco[t] >= 1.5) & (dfEco[t] < 2.5),  #  Moderate
-                        (dfEco[t] >= 2.5) & (dfEco[t] < 3.5),  #  Good
-                        dfEco[t] >= 3.5,  #  High
-                    ]
-                    # Ecological status as a categorical index from Bad to High quality
-                    dfEco[t] = np.select(conditions, [0, 1, 2, 3, 4], default=np.nan)
+                # Convert imp status to categorical scale w. equidistant thresholds
+                # (Bad, Poor, Moderate, Good, High) for all years at once
+                dfEcoObs[:] = status_module.classify(dfEcoObs, [0.5, 1.5, 2.5, 3.5])
+
+            # Panel of ecological status with basis analysis and shore length attached
+            panel = panel_module.Waterbody_Panel.from_frame(
+                dfEcoObs, dfVP[["Basis", "length"]]
+            )
+
+            # Observed ecological status each year with basis analysis for VP3
+            dfEco = panel.frame(["Basis"])
 
             if suffix != "imp_MA":
                 # Create missing values graph (heatmap of missing observations by year)
                 indexSorted = self.missing_values_graph(j, dfEco, suffix, index)
 
-            # Merge df for observed ecological status with df for characteristics
-            dfEcoLength = dfEco.merge(dfVP[["length"]], on="wb")
-
             # Calculate total length of all water bodies in current water body plan (VP2)
-            totalLength = dfEcoLength["length"].sum()
+            totalLength = np.nansum(panel["length"])
 
-            # Create an empty df for statistics
+            # Statistics for span of natural capital account & basis (all at once)
+            cols = self.years + ["Basis"]
             stats = pd.DataFrame(
-                index=self.years + ["Basis"],
+                status_module.shares(
+                    np.column_stack(
+                        [panel.matrix(self.year_first, self.year_last), panel["Basis"]]
+                    ),
+                    panel["length"],
+                ),
+                index=cols,
                 columns=[
                     "high",
                     "good",
@@ -902,29 +998,6 @@ class Water_Quality:
                 ],
             )
 
-            # Calculate the above statistics for span of natural capital account & basis
-            for t in self.years + ["Basis"]:
-                y = dfEcoLength[[t, "length"]].reset_index(drop=True)
-                y["high"] = np.select([y[t] == 4], [y["length"]])
-                y["good"] = np.select([y[t] == 3], [y["length"]])
-                y["moderate"] = np.select([y[t] == 2], [y["length"]])
-                y["poor"] = np.select([y[t] == 1], [y["length"]])
-                y["bad"] = np.select([y[t] == 0], [y["length"]])
-                y["not good"] = np.select([y[t] < 3], [y["length"]])
-                y["known"] = np.select([y[t].notna()], [y["length"]])
-
-                # Add shares of total length to stats
-                knownLength = y["known"].sum()
-                stats.loc[t] = [
-                    100 * y["high"].sum() / knownLength,
-                    100 * y["good"].sum() / knownLength,
-                    100 * y["moderate"].sum() / knownLength,
-                    100 * y["poor"].sum() / knownLength,
-                    100 * y["bad"].sum() / knownLength,
-                    100 * y["not good"].sum() / knownLength,
-                    100 * knownLength / totalLength,
-                ]
-
             # For imputed ecological status, convert to integers and drop 'known' column
             if suffix != "obs":
                 stats = stats.drop(columns="known")
@@ -980,49 +1053,15 @@ class Water_Quality:
                 # Copy DataFrame for the biophysical indicator
                 df = dfIndicator.copy()
 
-                # Convert DVFI fauna index for streams to index of ecological status
-                for t in df.columns:
-                    # Set conditions given the official guidelines for conversion
-                    conditions = [
-                        df[t] < 1.5,  # Bad
-                        (df[t] >= 1.5) & (df[t] < 3.5),  #  Poor
-                        (df[t] >= 3.5) & (df[t] < 4.5),  #  Moderate
-                        (df[t] >= 4.5) & (df[t] < 6.5),  #  Good
-                        df[t] >= 6.5,  #  High
-                    ]
-
-                    # Ecological status as a categorical scale from Bad to High quality
-                    df[t] = np.select(conditions, [0, 1, 2, 3, 4], default=np.nan)
-
-                return df
+                # Thresholds of the DVFI fauna index given the official guidelines
+                thresholds = [1.5, 3.5, 4.5, 6.5]
 
             elif j == "lakes":
                 # Merge df for biophysical indicator with df for typology
                 df = dfIndicator.merge(dfVP[["ov_typ"]], on="wb")
 
-                def set_threshold(row):
-                    if row["ov_typ"] in ["LWTYPE9", "LWTYPE11", "LWTYPE13", "LWTYPE15"]:
-                        return pd.Series(
-                            {
-                                "bad": 90,
-                                "poor": 56,
-                                "moderate": 25,
-                                "good": 11.7,
-                            }
-                        )
-
-                    else:
-                        return pd.Series(
-                            {
-                                "bad": 56,
-                                "poor": 27,
-                                "moderate": 12,
-                                "good": 7,
-                            }
-                        )
-
-                # For df, add the series of thresholds relative to High ecological status
-                df[cols] = df.apply(set_threshold, axis=1)
+                # Thresholds relative to High ecological status given the typology
+                thresholds = status_module.lake_thresholds(df["ov_typ"])
                 df = df.drop(columns=["ov_typ"])  #  drop typology column
 
             else:  #  coastal waters
@@ -1033,22 +1072,12 @@ class Water_Quality:
 
                 # Merge df for biophysical indicator with df for thresholds
                 df = dfIndicator.merge(thresholds[cols], on="wb")
+                thresholds = df[cols].to_numpy()
+                df = df.drop(columns=cols)  #  drop columns with thresholds
 
-            # Convert mean chlorophyll concentrations to index of ecological status
-            for t in dfIndicator.columns:
-                # Set conditions given the threshold for the typology of each lake
-                conditions = [
-                    df[t] >= df["bad"],
-                    (df[t] < df["bad"]) & (df[t] >= df["poor"]),
-                    (df[t] < df["poor"]) & (df[t] >= df["moderate"]),
-                    (df[t] < df["moderate"]) & (df[t] >= df["good"]),
-                    df[t] < df["good"],
-                ]
-                # Ordinal scale of ecological status: Bad, Poor, Moderate, Good, High
-                df[t] = np.select(conditions, [0, 1, 2, 3, 4], default=np.nan)
-
-            # Drop columns with thresholds
-            df = df.drop(columns=cols)
+            # Ordinal scale of ecological status: Bad, Poor, Moderate, Good, High for
+            # all water bodies and years at once (a lower chlorophyll level is better)
+            df[:] = status_module.classify(df, thresholds, increasing=j == "streams")
 
             return df
 
@@ -1111,22 +1140,33 @@ class Water_Quality:
             else:
                 type = j  # type of water body
 
-            # Plot heatmap
-            colorMap = sns.xkcd_palette(colors)
-            plt.figure(figsize=(10, 12))
-            ax = sns.heatmap(
-                df,
+            # Plot heatmap as a single image (one cell per pixel rather than a patch)
+            colorMap = ListedColormap(sns.xkcd_palette(colors))
+            fig, ax = plt.subplots(figsize=(10, 12))
+
+            # Most frequent status in blocks of rows if taller than the resolution
+            rows = int(fig.get_figheight() * fig.dpi)
+            image = status_module.downsample(df, rows, uniqueValues)
+            ax.imshow(
+                image,
                 cmap=colorMap,
-                cbar=False,
-                cbar_kws={"ticks": uniqueValues},
+                vmin=uniqueValues[0] - 0.5,  #  a color for each value
+                vmax=uniqueValues[-1] + 0.5,
+                aspect="auto",
+                interpolation="nearest",
+                extent=(0, df.shape[1], len(df), 0),
             )
-            ax.set(yticklabels=[])
+            ax.set_xticks(np.arange(df.shape[1]) + 0.5, df.columns, rotation=90)
+            ax.set(yticks=[])
+            for spine in ax.spines.values():
+                spine.set_visible(False)
             plt.ylabel(
                 str(len(df)) + " " + type + " ordered by observed ecological status"
             )
             plt.title(description)
             plt.tight_layout()
             plt.savefig("output\\" + j + "_eco_" + suffix + ".pdf", bbox_inches="tight")
+            plt.close(fig)  #  close figure to free up memory
 
             return index
 
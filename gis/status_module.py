@@ -0,0 +1,112 @@
+"""
+Name:       status_module.py
+
+Label:      Convert biophysical indicators to the EU index of ecological status.
+
+Summary:    ThorNoe.GitHub.io/GreenGDP explains the overall approach and methodology.
+
+Usage:      This module supports indicator_to_status() and ecological_status() in
+            script_module.py by classifying the whole matrix of water bodies by year
+            at once rather than a column (year) or row (water body) at a time.
+
+            The ecological status is the number of thresholds that the indicator
+            passes, e.g., a DVFI index of 5 passes the thresholds 1.5, 3.5, and 4.5 of
+            streams, i.e., Good ecological status (3). For chlorophyll, where a lower
+            concentration is better, the thresholds for Bad, Poor, Moderate, and Good
+            ecological status are given for each water body (row), e.g., by typology.
+
+            The statistics of ecological status weighted by length are computed for all
+            years in one weighted histogram (np.bincount) of the status matrix, so the
+            cost is negligible even for hundreds of thousands of water bodies.
+
+            For the missing values graph, downsample() reduces a panel that is taller
+            than the resolution of the figure to the most frequent status in each block
+            of consecutive rows, so the heatmap can be drawn as a single image.
+
+Functions:  The module contains 4 functions:
+            - classify() converts a matrix of indicators to ecological status.
+            - lake_thresholds() gives the thresholds of chlorophyll for each lake.
+            - shares() gives the shares of length by ecological status for each year.
+            - downsample() reduces the rows of a status matrix for the heatmap.
+
+License:    MIT Copyright (c) 2025
+Author:     Thor Donsby Noe
+"""
+
+import numpy as np
+
+
+def classify(values, thresholds, increasing=True):
+    """Ecological status from 0-4 for Bad, Poor, Moderate, Good, and High for each
+    element in the 2D array values (water bodies by years), missing if missing.
+
+    thresholds holds the four thresholds between the categories, either for all rows
+    (shape 4) or for each row (shape rows by 4). If increasing, the status is higher
+    for higher values of the indicator (e.g., the DVFI index), where a value that is
+    equal to a threshold belongs to the category above. Otherwise, the status is
+    lower for higher values (e.g., chlorophyll), where a value that is equal to a
+    threshold belongs to the category below, and the thresholds are given in the
+    order of Bad, Poor, Moderate, and Good."""
+    values = np.asarray(values, dtype=np.float64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    if thresholds.ndim == 2:
+        thresholds = thresholds[:, None, :]  #  the same thresholds for each year
+
+    # Count the thresholds that each value passes (one comparison for all cells)
+    if increasing:
+        status = (values[..., None] >= thresholds).sum(axis=-1)
+    else:
+        status = (values[..., None] < thresholds).sum(axis=-1)
+    return np.where(np.isnan(values), np.nan, status)
+
+
+def lake_thresholds(typology):
+    """Thresholds of chlorophyll for Bad, Poor, Moderate, and Good ecological status
+    for each lake given its typology (array of rows by 4). Lakes of type 9, 11, 13, and
+    15 have higher thresholds than other lakes."""
+    types = ["LWTYPE9", "LWTYPE11", "LWTYPE13", "LWTYPE15"]
+    listed = np.isin(np.asarray(typology), types)[:, None]
+    return np.where(listed, [90, 56, 25, 11.7], [56, 27, 12, 7])
+
+
+def shares(status, length):
+    """Shares of the length (e.g., shore length in km) with High, Good, Moderate, Poor,
+    Bad, and not Good (i.e., below Good) ecological status in percent of the length of
+    the water bodies with known status, and the share with known status in percent of
+    the total length, for each column of the 2D array status (water bodies by years).
+    Returns an array of columns by the 7 statistics. Missing lengths count as zero."""
+    status = np.asarray(status, dtype=np.float64)
+    length = np.nan_to_num(np.asarray(length, dtype=np.float64))
+    cols = status.shape[1]
+
+    # Weighted histogram of status 0-4 and missing (5) for all columns in one pass
+    bins = np.where(np.isnan(status), 5, status).astype(np.int64)
+    bins += 6 * np.arange(cols)  #  separate bins for each column
+    hist = np.bincount(bins.ravel(), np.repeat(length, cols), 6 * cols).reshape(cols, 6)
+
+    known = hist[:, :5].sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = 100 * hist[:, [4, 3, 2, 1, 0]] / known[:, None]
+        notGood = 100 * hist[:, :3].sum(axis=1) / known
+        return np.column_stack([share, notGood, 100 * known / length.sum()])
+
+
+def downsample(status, rows, categories=(-1, 0, 1, 2, 3, 4)):
+    """Most frequent category (e.g., -1 for missing and status 0-4) in each block of
+    consecutive rows of the 2D array status, such that at most the given number of rows
+    remain, for each column. Ties go to the lowest category. Returns status as is if it
+    has no more rows than that."""
+    status = np.asarray(status, dtype=np.float64)
+    n, m = status.shape
+    k = -(-n // max(rows, 1))  #  rows per block (rounded up)
+    if k <= 1:
+        return status
+    categories = np.asarray(categories, dtype=np.float64)
+    c = len(categories)
+
+    # Count the categories by block and column in one pass (weighted histogram)
+    codes = np.searchsorted(categories, status)
+    blocks = np.arange(n) // k
+    bins = (blocks[:, None] * m + np.arange(m)) * c + codes
+    counts = np.bincount(bins.ravel(), minlength=(blocks[-1] + 1) * m * c)
+    return categories[counts.reshape(-1, m, c).argmax(axis=-1)]
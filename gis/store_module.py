@@ -0,0 +1,254 @@
+"""
+Name:       store_module.py
+
+Label:      Columnar store of the data files exported from the ODA database.
+
+Summary:    ThorNoe.GitHub.io/GreenGDP explains the overall approach and methodology.
+
+Usage:      This module supports longitudinal() in script_module.py. Reading an Excel
+            export from ODAforalle.au.dk takes long (e.g., lakes_chlorophyll.xlsx),
+            and the historical export for streams is used for three monitoring versions.
+            Instead, each export is converted once into a typed Parquet dataset that is
+            partitioned by year and kept in the subfolder data/store/<file name>/<hash>.
+
+            The hash identifies the content of the export, so replacing the file in the
+            data folder (e.g., after an update of the ODA database) triggers a new
+            conversion, while later runs read the dataset in a fraction of a second.
+            Reading can be limited to some years, stations, or parameters, which are
+            pushed down to the Parquet files (only the relevant parts are read).
+
+            Exports above the row limit of Excel can be placed in the data folder as CSV
+            files (also compressed, e.g., .csv.gz) instead of splitting them by hand.
+            A CSV export is converted chunk by chunk, so only one chunk is in memory at
+            a time (e.g., a national multi-decade export of chlorophyll measurements),
+            and reading the parameter and years of interest from the store afterwards
+            only loads the relevant rows.
+
+            The layers of the water body plan (see wfs_module.py) are kept in the store
+            as GeoParquet files, e.g., data/store/vp3e2022_soe_samlet.parquet, with the
+            geometries as WKB and the bounding box of each geometry. The rows are sorted
+            along the x-axis of the bounding boxes, so a read limited to a bounding box
+            only loads the relevant row groups. A layer loads in milliseconds, and a
+            spatial index (STRtree) is bulk-loaded from the geometries when needed.
+
+            Requires pyarrow. Conversion of Excel files requires openpyxl.
+
+Functions:  The module contains 7 functions:
+            - read() returns the observations from the store, which calls:
+                - ingest() to convert the export if it is not in the store, which calls:
+                    - file_hash()
+                    - csv_chunks() to read a CSV export chunk by chunk
+            - write_geometries() and read_geometries() keep the layers as GeoParquet.
+            - geometries_hash() identifies the content of a layer.
+
+License:    MIT Copyright (c) 2025
+Author:     Thor Donsby Noe
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+
+def file_hash(path, chunk=1 << 20):
+    """Hash of the content of a file (first 16 characters of SHA-256)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()[:16]
+
+
+def geometries_hash(df):
+    """Hash of the attributes and geometries (shapely, in the column 'geometry') of a
+    layer (first 16 characters of SHA-256 of the attributes and the WKB)."""
+    h = hashlib.sha256()
+    h.update(df.drop(columns="geometry").to_json(orient="values").encode())
+    for wkb in shapely.to_wkb(df["geometry"].to_numpy()):
+        h.update(wkb or b"")  #  missing geometries are None
+    return h.hexdigest()[:16]
+
+
+def csv_chunks(path, chunksize=500_000):
+    """Read the CSV file at path in chunks of rows with the same column types in all
+    chunks. Returns a generator of the chunks and the schema of the columns.
+
+    A first pass over the file infers the type of each column from all chunks, e.g.,
+    a column of integers with the value "U" in any chunk is read as text in all chunks,
+    and a column of integers with missing values in any chunk as decimal numbers.
+    Separators are detected from the header (semicolon-separated exports from ODA use
+    decimal commas)."""
+    semicolon = len(pd.read_csv(path, sep=";", nrows=0).columns) > 1
+    sep, decimal = (";", ",") if semicolon else (",", ".")
+    kwargs = dict(sep=sep, decimal=decimal, chunksize=chunksize)
+
+    # First pass: type of each column given its types in all chunks
+    kinds = {}
+    with pd.read_csv(path, **kwargs) as reader:
+        for chunk in reader:
+            for c, t in chunk.dtypes.items():
+                kinds.setdefault(c, set()).add(t.kind if t.kind in "bfi" else "O")
+    dtypes, fields = {}, []
+    for c, k in kinds.items():
+        if k <= {"i"}:
+            dtypes[c], t = np.int64, pa.int64()  #  integers in all chunks
+        elif k <= {"f", "i"}:
+            dtypes[c], t = np.float64, pa.float64()  #  numbers (or missing values)
+        elif k == {"b"}:
+            dtypes[c], t = bool, pa.bool_()
+        else:
+            dtypes[c], t = str, pa.string()  #  text in any chunk
+        fields.append((c, t))
+
+    # Second pass: read the chunks with the same column types
+    def chunks():
+        with pd.read_csv(path, dtype=dtypes, **kwargs) as reader:
+            yield from reader
+
+    return chunks(), pa.schema(fields)
+
+
+def ingest(f, d, folder="data", reader=None, chunksize=500_000):
+    """Convert the export f in the folder to a Parquet dataset partitioned by the year
+    of the date column d (unless the current version is in the store already) and
+    return the path of the dataset. Earlier versions of the export are removed.
+
+    Columns with both numbers and text (e.g., the DVFI index value "U" for unknown) are
+    stored as text, while missing values remain missing. CSV files are converted in
+    chunks of rows (see csv_chunks). Use reader to read other file types than Excel
+    (xlsx/xls) and CSV files."""
+    path = os.path.join(folder, f)
+    stem = os.path.join(folder, "store", f.split(".")[0])
+    root = os.path.join(stem, file_hash(path))
+    if os.path.isdir(root):
+        return root  #  the current version is in the store already
+
+    # Read the export once (chunk by chunk for CSV files)
+    schema = None
+    if reader is not None:
+        chunks = [reader(path)]
+    elif ".csv" in f.lower():
+        chunks, schema = csv_chunks(path, chunksize)
+        schema = schema.append(pa.field("year", pa.int64()))
+    else:
+        chunks = [pd.read_excel(path)]
+
+    # Write to a temporary folder first, so an interrupted conversion is not used
+    temp = root + "_temp"
+    shutil.rmtree(temp, ignore_errors=True)
+    for i, df in enumerate(chunks):
+        # Typed columns: mixed columns are stored as text (missing values remain missing)
+        for c in df.columns[df.dtypes == object]:
+            df[c] = df[c].where(df[c].isna(), df[c].astype(str)).replace({np.nan: None})
+
+        # Year of the date column (e.g., 20120412 or a datetime) to partition the dataset
+        df["year"] = df[d].astype(str).str.slice(0, 4).astype(int)
+
+        table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        pq.write_to_dataset(
+            table,
+            temp,
+            partition_cols=["year"],
+            basename_template=f"part{i:05d}-{{i}}.parquet",  #  in order of rows
+        )
+    for old in os.listdir(stem):
+        if os.path.join(stem, old) != temp:
+            shutil.rmtree(os.path.join(stem, old))  #  remove earlier versions of export
+    os.rename(temp, root)
+    return root
+
+
+def read(f, d, columns=None, years=None, stations=None, filters=None, folder="data"):
+    """Read the export f with date column d from the store (see ingest). Optionally,
+    read only the given columns and the rows of the given years and stations (IDs in
+    the column ObservationsStedNr) or that meet other filters in the format of pyarrow,
+    e.g., [("Indekstype", "==", "DVFI")]. The year is added as an integer column."""
+    root = ingest(f, d, folder)
+    filters = list(filters or [])
+    if years is not None:
+        filters.append(("year", "in", [int(t) for t in years]))
+    if stations is not None:
+        filters.append(("ObservationsStedNr", "in", list(stations)))
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + [d, "year"]))  #  unique
+    df = pd.read_parquet(root, columns=columns, filters=filters or None)
+    df["year"] = df["year"].astype(int)  #  partition column is read as categorical
+    return df
+
+
+def write_geometries(df, name, crs="EPSG:25832", folder="data", row_group=1000):
+    """Save the DataFrame df with shapely geometries in the column 'geometry' (e.g., a
+    layer of the water body plan) as data/store/<name>.parquet in GeoParquet format
+    with the bounding box of each geometry. Returns the path of the file."""
+    path = os.path.join(folder, "store", name + ".parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Bounding box of each geometry; sort the rows along the x-axis for filtering
+    geometry = df["geometry"].to_numpy()
+    bounds = shapely.bounds(geometry)
+    order = np.argsort(bounds[:, 0], kind="stable")
+    df = df.drop(columns="geometry").iloc[order].reset_index(drop=True)
+    for i, c in enumerate(["xmin", "ymin", "xmax", "ymax"]):
+        df[c] = bounds[order, i]
+    df["geometry"] = shapely.to_wkb(geometry[order])
+
+    # Metadata of the geometry column (GeoParquet 1.0.0)
+    types = sorted(set(shapely.get_type_id(geometry[pd.notna(geometry)]).tolist()))
+    names = ["Point", "LineString", "LinearRing", "Polygon", "MultiPoint"]
+    names += ["MultiLineString", "MultiPolygon", "GeometryCollection"]
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {
+            "geometry": {
+                "encoding": "WKB",
+                "geometry_types": [names[t] for t in types],
+                "crs": {"id": {"authority": "EPSG", "code": int(crs.split(":")[1])}},
+                "bbox": [
+                    np.nanmin(bounds[:, 0]),
+                    np.nanmin(bounds[:, 1]),
+                    np.nanmax(bounds[:, 2]),
+                    np.nanmax(bounds[:, 3]),
+                ],
+            }
+        },
+    }
+
+    # Write to a temporary file first, so an interrupted write is not used
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = {**table.schema.metadata, b"geo": json.dumps(geo).encode()}
+    table = table.replace_schema_metadata(metadata)
+    pq.write_table(table, path + "_temp", row_group_size=row_group)
+    os.replace(path + "_temp", path)
+    return path
+
+
+def read_geometries(name, columns=None, bbox=None, folder="data"):
+    """Read the layer saved by write_geometries() with the geometries (shapely) in the
+    column 'geometry'. Optionally, read only the given columns and the geometries that
+    intersect the bounding box (xmin, ymin, xmax, ymax). Returns None if the layer is
+    not in the store."""
+    path = os.path.join(folder, "store", name + ".parquet")
+    if not os.path.exists(path):
+        return None
+    filters = None
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = bbox
+        filters = [
+            ("xmax", ">=", xmin),
+            ("xmin", "<=", xmax),
+            ("ymax", ">=", ymin),
+            ("ymin", "<=", ymax),
+        ]
+    if columns is not None:
+        columns = list(columns) + ["geometry"]
+    df = pd.read_parquet(path, columns=columns, filters=filters)
+    df["geometry"] = shapely.from_wkb(df["geometry"].to_numpy())
+    return df.drop(columns=["xmin", "ymin", "xmax", "ymax"], errors="ignore")
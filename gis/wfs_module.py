@@ -0,0 +1,170 @@
+"""
+Name:       wfs_module.py
+
+Label:      Download layers of the water body plan from a WFS service without ArcPy.
+
+Summary:    ThorNoe.GitHub.io/GreenGDP explains the overall approach and methodology.
+
+Usage:      This module supports get_layers_from_WFS() in script_module.py. Rather than
+            downloading every attribute of a layer at once (WFSToFeatureClass in ArcGIS
+            stops at max_features), the WFS service (e.g., MiljøGIS) is only asked for
+            the relevant fields and the geometry, and the features are requested page
+            by page until the layer is complete. The next page starts after the
+            features returned so far (the server may cap the page size), the pages are
+            sorted by a unique key, and both the count (against the number of features
+            matched by the server) and the uniqueness of the feature ids are checked.
+            The layers are fetched concurrently.
+
+            Every response is cached on disk in data/wfs along with its ETag and
+            Last-Modified headers. Later requests are revalidated with the server, so
+            an unchanged page is not downloaded again (HTTP 304 Not Modified).
+
+            The client only uses standard WFS 2.0.0 requests (DescribeFeatureType and
+            GetFeature with GeoJSON output), so it can be tested against a local
+            stand-in WFS server by passing its URL instead of the URL of MiljøGIS.
+
+            Requires shapely 2.0 or later.
+
+Functions:  The module contains 5 functions:
+            - get_layers() downloads several layers concurrently, which calls:
+                - get_features() for each layer, which calls:
+                    - geometry_field() to find the name of the geometry field
+                    - fetch() for each page, which calls:
+                        - request_url()
+
+License:    MIT Copyright (c) 2025
+Author:     Thor Donsby Noe
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+
+import pandas as pd
+import shapely
+
+
+def request_url(service, **params):
+    """URL of a WFS 2.0.0 request to the service (any query of the service URL, e.g.,
+    ?service=WFS&request=Getcapabilities, is replaced by the parameters)."""
+    url = urllib.parse.urlsplit(service)
+    query = urllib.parse.urlencode({"service": "WFS", "version": "2.0.0", **params})
+    return urllib.parse.urlunsplit(url._replace(query=query, fragment=""))
+
+
+def fetch(url, cache=os.path.join("data", "wfs"), timeout=300):
+    """Content of the response to the url. The response is cached on disk along with
+    its ETag and Last-Modified headers and revalidated with the server next time."""
+    os.makedirs(cache, exist_ok=True)
+    path = os.path.join(cache, hashlib.sha256(url.encode()).hexdigest()[:16])
+
+    # Ask the server whether the cached response is still valid
+    request = urllib.request.Request(url)
+    if os.path.exists(path) and os.path.exists(path + ".json"):
+        with open(path + ".json") as file:
+            headers = json.load(file)
+        if headers.get("ETag"):
+            request.add_header("If-None-Match", headers["ETag"])
+        if headers.get("Last-Modified"):
+            request.add_header("If-Modified-Since", headers["Last-Modified"])
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            content = response.read()
+            headers = {h: response.headers.get(h) for h in ("ETag", "Last-Modified")}
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        with open(path, "rb") as file:
+            return file.read()  #  not modified since the cached response
+
+    # Cache the response (write to a temporary file first)
+    with open(path + "_temp", "wb") as file:
+        file.write(content)
+    os.replace(path + "_temp", path)
+    with open(path + ".json", "w") as file:
+        json.dump({"url": url, **headers}, file)
+    return content
+
+
+def geometry_field(service, typeName, **kwargs):
+    """Name of the geometry field of the feature type (from DescribeFeatureType)."""
+    url = request_url(service, request="DescribeFeatureType", typeNames=typeName)
+    schema = ET.fromstring(fetch(url, **kwargs))
+    for element in schema.iter("{http://www.w3.org/2001/XMLSchema}element"):
+        if element.get("type", "").startswith("gml:"):
+            return element.get("name")  #  e.g., gml:MultiSurfacePropertyType
+    raise ValueError("No geometry field in the feature type " + typeName)
+
+
+def get_features(
+    service, typeName, fields, key=None, page=1000, srs="EPSG:25832", **kwargs
+):
+    """Features of the feature type with the given fields and their geometries in the
+    spatial reference system srs (ETRS 1989 UTM Zone 32N). The features are requested
+    in pages of the given size (or less if the server caps the page size) sorted by a
+    unique key, so the pages are stable between requests: the field key if given, or
+    else the feature id (the order of the server without sortBy, e.g., GeoServer sorts
+    by the primary key). The fields themselves are not unique (e.g., the segments of a
+    stream share ov_id), so the ids of the features are checked to be unique.
+    Returns a DataFrame with a column for each field and the geometries (shapely) in
+    the column 'geometry'."""
+    geometry = geometry_field(service, typeName, **kwargs)
+    rows, ids, previous, matched = [], [], None, None
+    order = {} if key is None else {"sortBy": key}
+    while True:
+        url = request_url(
+            service,
+            request="GetFeature",
+            typeNames=typeName,
+            propertyName=",".join(list(fields) + [geometry]),
+            outputFormat="application/json",
+            srsName=srs,
+            count=page,
+            startIndex=len(rows),
+            **order,
+        )
+        response = json.loads(fetch(url, **kwargs))
+        features = response["features"]
+        pageIds = [f.get("id") for f in features]
+        if not features or pageIds == previous:
+            break  #  no more features (or the server ignores startIndex)
+        previous = pageIds
+        for f in features:
+            properties = f.get("properties") or {}
+            row = [properties.get(c) for c in fields]
+            row.append(shapely.geometry.shape(f["geometry"]) if f["geometry"] else None)
+            rows.append(row)
+        ids += pageIds
+        matched = response.get("numberMatched")  #  total number (or "unknown")
+        if isinstance(matched, int) and len(rows) >= matched:
+            break  #  last page
+    if isinstance(matched, int) and len(rows) != matched:
+        raise ValueError(
+            "{0} of {1} features of {2} were returned".format(
+                len(rows), matched, typeName
+            )
+        )
+    if None not in ids and len(set(ids)) != len(ids):
+        raise ValueError(
+            "{0} features of {1} were returned twice, as the pages are not sorted by a "
+            "unique key".format(len(ids) - len(set(ids)), typeName)
+        )
+    return pd.DataFrame(rows, columns=list(fields) + ["geometry"])
+
+
+def get_layers(service, layers, n_jobs=4, **kwargs):
+    """Download several layers concurrently, where layers is a dictionary of the
+    feature type and fields for each key, e.g., {"lakes": ("vp3e2022_soe_samlet",
+    ["ov_id", "ov_navn"])}. Returns a dictionary of DataFrames (see get_features)."""
+    with concurrent.futures.ThreadPoolExecutor(max(1, n_jobs)) as executor:
+        futures = {
+            key: executor.submit(get_features, service, typeName, fields, **kwargs)
+            for key, (typeName, fields) in layers.items()
+        }
+        return {key: future.result() for key, future in futures.items()}